@@ -8,11 +8,27 @@ WORK_DIR=data/$(date +%Y-%m-%d)
 if [ -d $WORK_DIR ]; then rm -r $WORK_DIR; fi
 mkdir -p $WORK_DIR
 ln -s ../done.txt $WORK_DIR/done.txt
+if [ -f data/ledger.sqlite ]; then cp data/ledger.sqlite $WORK_DIR/ledger.sqlite; fi
+if [ -f data/oa_file_list.sqlite ]; then cp data/oa_file_list.sqlite $WORK_DIR/oa_file_list.sqlite; fi
 
 echo "assembling output.gmt... (new gene sets extracted from PMC articles)"
-PTH=$WORK_DIR $PYTHON ./download_extract.py || exit 1
+if [ "${SHARDS:-1}" -gt 1 ]; then
+  # split the work between $SHARDS local processes, then merge their outputs
+  PROCESSES=$(( $(nproc) / SHARDS ))
+  if [ $PROCESSES -lt 1 ]; then PROCESSES=1; fi
+  PIDS=""
+  for SHARD in $(seq 0 $(( SHARDS - 1 ))); do
+    PTH=$WORK_DIR $PYTHON ./download_extract.py --shard $SHARD/$SHARDS -j $PROCESSES &
+    PIDS="$PIDS $!"
+  done
+  for PID in $PIDS; do wait $PID || exit 1; done
+  $PYTHON -m helper merge-shards -d $WORK_DIR || exit 1
+else
+  PTH=$WORK_DIR $PYTHON ./download_extract.py || exit 1
+fi
 test -f $WORK_DIR/output.gmt || exit 1
 test -f $WORK_DIR/done.new.txt || exit 1
+test -f $WORK_DIR/ledger.sqlite || exit 1
 
 echo "assembling output-clean.gmt... (pruned, and normalized gene sets)"
 $PYTHON -m helper clean -i $WORK_DIR/output.gmt -o $WORK_DIR/output-clean.gmt || exit 1
@@ -28,12 +44,14 @@ echo "fetching & ingesting gene description & summary..."
 $PYTHON -m helper ingest-gene-info || exit 1
 
 echo "registering a new release..."
-$PYTHON -m helper create-release "$(wc -l $WORK_DIR/done.new.txt | awk '{ print $1 }')" || exit 1
+$PYTHON -m helper create-release "$($PYTHON -m helper ledger-count -i $WORK_DIR/ledger.sqlite --new-only)" || exit 1
 
 echo "adding to output.gmt..."
 cat $WORK_DIR/output.gmt >> data/output.gmt
 cat $WORK_DIR/output-clean.gmt >> data/output-clean.gmt
 cat $WORK_DIR/done.new.txt >> data/done.txt
+cp $WORK_DIR/ledger.sqlite data/ledger.sqlite
+cp $WORK_DIR/oa_file_list.sqlite data/oa_file_list.sqlite
 
 echo "updating app background..."
 ENRICH_URL=$ENRICH_URL $PYTHON -m helper update-background || exit 1
@@ -2,74 +2,368 @@ import re
 import io
 import os
 import csv
+import gzip
+import json
 import sys
+import time
+import atexit
 import queue
+import collections
 import shutil
 import tarfile
+import zipfile
+import functools
+import itertools
+import threading
 import tempfile
 import traceback
 import contextlib
 import subprocess
 import multiprocessing as mp
-from multiprocessing.pool import ThreadPool
-import urllib.request
 import xml.etree.ElementTree as ET
 from pathlib import Path, PurePosixPath
 
 import tqdm
+import click
 import numpy as np
+import requests
 import pandas as pd
 
+from helper.lookup import gene_lookup, open_lookup
+from helper.ledger import Ledger
+from helper.cache import content_key, open_cache
+from helper.report import TimingReport
+from helper.oa_file_list import FileList, oa_file_list_url
+
 java = shutil.which('java')
 assert java, 'Missing java, necessary for tabula-py'
 
 soffice = shutil.which('soffice', path=':'.join(filter(None, [os.environ.get('PATH'), '/Applications/LibreOffice.app/Contents/MacOS/'])))
 assert soffice, 'Missing `soffice` binary for converting doc to docx'
 
-class _DevNull:
-  ''' File handle that does nothing
+def _stop_process(proc):
+  ''' Ask a process to stop, escalating to terminate & kill if it doesn't
+  '''
+  proc.join(1)
+  if proc.exitcode is None:
+    import signal
+    try: os.kill(proc.pid, signal.SIGINT)
+    except ProcessLookupError: pass
+    proc.join(1)
+    if proc.exitcode is None:
+      proc.terminate()
+      proc.join(1)
+      if proc.exitcode is None:
+        proc.kill()
+        proc.join(1)
+
+class TaskTimeoutError(TimeoutError):
+  ''' A task ran out of time, `partial` has what it sent with emit_partial before it did
+  '''
+  def __init__(self, partial=()):
+    super().__init__()
+    self.partial = list(partial)
+
+# set in the process running a task (see: run_with_timeout, WorkerPool) to stream partial results to the parent
+_emit_partial = None
+
+def emit_partial(partial):
+  ''' Send a partial result of the current task to the parent, these survive the task timing out
+  (see: TaskTimeoutError). This does nothing when the task isn't running in a child process.
+  '''
+  if _emit_partial is not None:
+    _emit_partial(partial)
+
+# set in the process running a task (see: run_with_timeout, WorkerPool) to tell the parent about helper processes
+_emit_helper = None
+
+def register_helper(pid, path=None):
+  ''' Tell the parent about a helper process this one started (the leader of its own process group)
+  & its temporary directory. Processes exit without running atexit handlers when they're stopped (or
+  recycled), the parent kills the helper & removes the directory once this process is stopped.
+  '''
+  if _emit_helper is not None:
+    _emit_helper(('helper', pid, path))
+
+def unregister_helper(pid):
+  ''' The helper process was cleaned up by this one, see: register_helper
+  '''
+  if _emit_helper is not None:
+    _emit_helper(('helper_closed', pid, None))
+
+def _reap_helpers(helpers: dict):
+  ''' Kill the helper processes (pid -> directory, see: register_helper) of a stopped process
   '''
-  def write(self, *args, **kwargs): pass
-  def flush(self, *args, **kwargs): pass
+  import signal
+  for pid, path in helpers.items():
+    try: os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError): pass
+    if path is not None:
+      shutil.rmtree(path, ignore_errors=True)
+  helpers.clear()
+
+def _track_helper(helpers: dict, kind, pid, path):
+  if kind == 'helper': helpers[pid] = path
+  else: helpers.pop(pid, None)
 
-def _run_with_timeout(send, fn, *args):
+def _run_with_timeout(send, initializer, initargs, fn, *args):
+  global _emit_partial, _emit_helper
+  _emit_partial = lambda partial: send.put(('partial', partial))
+  _emit_helper = send.put
   try:
-    send.put((None, fn(*args)))
+    if initializer is not None:
+      initializer(*initargs)
+    send.put(('result', None, fn(*args)))
   except Exception as e:
-    send.put((e, None))
+    send.put(('result', e, None))
 
-def run_with_timeout(fn, *args, timeout: int = 60):
+def run_with_timeout(fn, *args, timeout: int = 60, initializer=None, initargs=()):
+  ''' Run fn(*args) in a freshly spawned process, after initializer(*initargs) (i.e. to apply
+  the same settings as a WorkerPool's), raising TaskTimeoutError if it takes longer than timeout
+  '''
   mp_spawn = mp.get_context('spawn')
   recv = mp_spawn.Queue()
-  proc = mp_spawn.Process(target=_run_with_timeout, args=(recv, fn, *args))
+  proc = mp_spawn.Process(target=_run_with_timeout, args=(recv, initializer, initargs, fn, *args))
   proc.start()
+  partial = []
+  helpers = {}
+  deadline = time.monotonic() + timeout
   try:
-    err, res = recv.get(timeout=timeout)
-  except queue.Empty:
+    while True:
+      try:
+        kind, *msg = recv.get(timeout=max(0, deadline - time.monotonic()))
+      except queue.Empty:
+        raise TaskTimeoutError(partial)
+      if kind == 'partial':
+        partial.append(msg[0])
+        continue
+      if kind in ('helper', 'helper_closed'):
+        _track_helper(helpers, kind, *msg)
+        continue
+      err, res = msg
+      if err is not None:
+        raise err
+      else:
+        return res
+  finally:
+    _stop_process(proc)
+    _reap_helpers(helpers)
+
+def _call_in_thread(fn, *args, timeout: int = 60):
+  ''' Call fn in a thread, raising TimeoutError if it doesn't finish in time. This is for
+  calls we can't interrupt (i.e. blocked on another process/the JVM), the thread is
+  abandoned in that case.
+  '''
+  result = {}
+  def target():
+    try: result['res'] = fn(*args)
+    except BaseException as e: result['err'] = e
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  thread.join(timeout)
+  if thread.is_alive():
     raise TimeoutError()
-  else:
-    if err is not None:
-      raise err
-    else:
+  if 'err' in result:
+    raise result['err']
+  return result['res']
+
+def _rss():
+  ''' The current resident set size of this process in bytes
+  '''
+  try:
+    with open('/proc/self/statm', 'r') as fr:
+      return int(fr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError, IndexError):
+    # not linux, fall back to the peak rss (reported in KiB)
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# set by a task (see: request_recycle) when the worker shouldn't be re-used after it
+_recycle_requested = False
+
+def request_recycle():
+  ''' Ask the WorkerPool to replace this worker once the current task is done,
+  i.e. when it was left with a runaway thread
+  '''
+  global _recycle_requested
+  _recycle_requested = True
+
+def _worker_loop(conn, initializer, initargs):
+  ''' The body of a WorkerPool process, receives (fn, args) tasks until it gets None
+  '''
+  global _emit_partial, _emit_helper
+  _emit_partial = lambda partial: conn.send(('partial', partial))
+  _emit_helper = conn.send
+  if initializer is not None:
+    initializer(*initargs)
+  while True:
+    try:
+      msg = conn.recv()
+    except EOFError:
+      break
+    if msg is None:
+      break
+    fn, args = msg
+    try:
+      err, res = None, fn(*args)
+    except Exception as e:
+      err, res = e, None
+    try:
+      conn.send(('result', err, res, _rss(), _recycle_requested))
+    except Exception:
+      # the exception/result couldn't be pickled, send the traceback instead
+      conn.send(('result', RuntimeError(traceback.format_exc()), None, _rss(), _recycle_requested))
+
+class _Worker:
+  def __init__(self, proc, conn):
+    self.proc = proc
+    self.conn = conn
+    self.tasks = 0
+    # see: register_helper
+    self.helpers = {}
+
+class WorkerPool:
+  ''' A pool of long-lived worker processes. Unlike run_with_timeout, which spawns a fresh
+  process (re-importing everything) for every call, these are started once, pre-warmed
+  with `initializer` and re-used.
+
+  A worker which exceeds its timeout is killed & replaced, workers are also recycled after
+  `max_tasks` tasks, once their resident memory exceeds `max_rss` bytes or when they
+  request_recycle().
+  '''
+  def __init__(self, processes=None, initializer=None, initargs=(), max_tasks=100, max_rss=2*1024**3):
+    self._ctx = mp.get_context('spawn')
+    self.initializer = initializer
+    self.initargs = initargs
+    self.max_tasks = max_tasks
+    self.max_rss = max_rss
+    self._idle = queue.Queue()
+    for _ in range(processes or os.cpu_count()):
+      self._idle.put(self._spawn())
+
+  def _spawn(self):
+    conn, child_conn = self._ctx.Pipe()
+    proc = self._ctx.Process(target=_worker_loop, args=(child_conn, self.initializer, self.initargs), daemon=True)
+    proc.start()
+    child_conn.close()
+    return _Worker(proc, conn)
+
+  def _replace(self, worker, graceful=False):
+    if graceful:
+      try: worker.conn.send(None)
+      except (OSError, ValueError): pass
+    _stop_process(worker.proc)
+    _reap_helpers(worker.helpers)
+    worker.conn.close()
+    return self._spawn()
+
+  def run(self, fn, *args, timeout: int = 60):
+    ''' Like run_with_timeout, but on one of the pool's workers
+    '''
+    worker = self._idle.get()
+    partial = []
+    try:
+      try:
+        worker.conn.send((fn, args))
+        deadline = time.monotonic() + timeout
+        while True:
+          if not worker.conn.poll(max(0, deadline - time.monotonic())):
+            raise TaskTimeoutError(partial)
+          kind, *msg = worker.conn.recv()
+          if kind == 'partial':
+            partial.append(msg[0])
+          elif kind in ('helper', 'helper_closed'):
+            _track_helper(worker.helpers, kind, *msg)
+          else:
+            break
+        err, res, rss, recycle = msg
+      except BaseException:
+        # the worker hung, died or we were interrupted, either way it's in an unknown state
+        worker = self._replace(worker)
+        raise
+      worker.tasks += 1
+      if recycle or worker.tasks >= self.max_tasks or rss > self.max_rss:
+        worker = self._replace(worker, graceful=True)
+      if err is not None:
+        raise err
       return res
+    finally:
+      self._idle.put(worker)
+
+  def close(self):
+    while True:
+      try:
+        worker = self._idle.get_nowait()
+      except queue.Empty:
+        break
+      try: worker.conn.send(None)
+      except (OSError, ValueError): pass
+      _stop_process(worker.proc)
+      _reap_helpers(worker.helpers)
+      worker.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+# statistics about the package being extracted, reset for each package by extract_oa_package_file
+package_stats = collections.Counter()
+# detailed timings (i.e. of each pdf) of the package being extracted
+package_timings = []
+# members, bytes & seconds spent by the handler of each extension on the package being extracted
+package_handlers = {}
+# the outcome & seconds of each supplementary file of the package being extracted
+package_members = []
+# seconds a single supplementary file may take before it's dropped (0 for no limit)
+member_timeout = 60*2
+def _track_temp_disk(n_bytes):
+  ''' Account for n_bytes of temporary files created (or removed, when negative) while
+  extracting the package, keeping track of the peak & total bytes written
+  '''
+  package_stats['temp_disk'] += n_bytes
+  package_stats['temp_disk_peak'] = max(package_stats['temp_disk_peak'], package_stats['temp_disk'])
+  if n_bytes > 0:
+    package_stats['temp_bytes_written'] += n_bytes
+
+# seconds spent in each stage of extracting the package being extracted, exclusive of nested stages
+package_stages = collections.Counter()
+_stage_stack = []
+
+@contextlib.contextmanager
+def _stage(name):
+  ''' Time the block as the stage `name` of package_stages, the time spent in a stage nested
+  within it is only counted towards the nested stage
+  '''
+  now = time.perf_counter()
+  if _stage_stack:
+    outer = _stage_stack[-1]
+    package_stages[outer[0]] += now - outer[1]
+  _stage_stack.append([name, now])
+  try:
+    yield
   finally:
-    proc.join(1)
-    if proc.exitcode is None:
-      import signal
-      try: os.kill(proc.pid, signal.SIGINT)
-      except ProcessLookupError: pass
-      proc.join(1)
-      if proc.exitcode is None:
-        proc.terminate()
-        proc.join(1)
-        if proc.exitcode is None:
-          proc.kill()
-          proc.join(1)
+    now = time.perf_counter()
+    name, since = _stage_stack.pop()
+    package_stages[name] += now - since
+    if _stage_stack:
+      _stage_stack[-1][1] = now
+
+# the SupplementCache of this worker, if any (see: _warm_worker)
+supplement_cache = None
+# bump when changes to the handlers or extract_gene_set_columns would change cached results
+supplement_cache_version = 1
+# the supplementary file being handled
+current_member = None
 
 ext_handlers = {}
 def register_ext_handler(*exts):
   ''' We create a dictionary with functions capable of extracting tables for each extension type.
   Each function is a generator of (name, pandas data frame) tuples
+
+  Handlers should avoid fully parsing tables which can't contain gene sets, i.e. by first
+  reading the first sniff_rows rows and checking them with _sniff_gene_columns.
   '''
   def decorator(func):
     for ext in exts:
@@ -77,34 +371,234 @@ def register_ext_handler(*exts):
     return func
   return decorator
 
-def _read_docx_tab(tab):
-  '''  This converts from a docx table object into a pandas dataframe
+_w = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def _read_docx_run_text(r):
+  ''' The text of a w:r element, mirroring python-docx
+  '''
+  text = []
+  for el in r:
+    if el.tag == _w+'t': text.append(el.text or '')
+    elif el.tag in (_w+'tab', _w+'ptab'): text.append('\t')
+    elif el.tag == _w+'cr': text.append('\n')
+    elif el.tag == _w+'br' and el.get(_w+'type', 'textWrapping') == 'textWrapping': text.append('\n')
+    elif el.tag == _w+'noBreakHyphen': text.append('-')
+  return ''.join(text)
+
+def _read_docx_cell_text(tc):
+  ''' The text of a w:tc element, its paragraphs separated by newlines (like python-docx's cell.text)
+  '''
+  return '\n'.join(
+    ''.join(
+      _read_docx_run_text(r)
+      for el in p
+      for r in ((el,) if el.tag == _w+'r' else el.findall(_w+'r') if el.tag == _w+'hyperlink' else ())
+    )
+    for p in tc.findall(_w+'p')
+  )
+
+def _read_docx_tab(tbl):
+  ''' This converts from a w:tbl element into a pandas dataframe. Like python-docx's row.cells,
+  horizontally merged cells are repeated for each grid column they span and vertically merged
+  cells repeat the text of the cell the merge started in.
   '''
-  vf = io.StringIO()
-  writer = csv.writer(vf)
-  for row in tab.rows:
-    writer.writerow(cell.text for cell in row.cells)
-  vf.seek(0)
-  return pd.read_csv(vf)
+  rows = []
+  above = {}
+  for tr in tbl.findall(_w+'tr'):
+    grid_before = tr.find(f"{_w}trPr/{_w}gridBefore")
+    offset = int(grid_before.get(_w+'val')) if grid_before is not None else 0
+    row = []
+    current = {}
+    for tc in tr.findall(_w+'tc'):
+      grid_span = tc.find(f"{_w}tcPr/{_w}gridSpan")
+      span = int(grid_span.get(_w+'val')) if grid_span is not None else 1
+      v_merge = tc.find(f"{_w}tcPr/{_w}vMerge")
+      if v_merge is not None and v_merge.get(_w+'val', 'continue') == 'continue':
+        text, span = above.get(offset, ('', span))
+      else:
+        text = _read_docx_cell_text(tc)
+      current[offset] = (text, span)
+      row += [text]*span
+      offset += span
+    above = current
+    rows.append(row)
+  rows = [row for row in rows if row]
+  if len({len(row) for row in rows}) != 1:
+    # ragged tables are rare and have some parser specific edge cases, use the csv parser for those
+    vf = io.StringIO()
+    writer = csv.writer(vf)
+    for row in rows:
+      writer.writerow(row)
+    vf.seek(0)
+    return pd.read_csv(vf)
+  from pandas.io.parsers import TextParser
+  return TextParser(rows, header=0, skip_blank_lines=False).read()
+
+def _docx_document_part(zf: zipfile.ZipFile):
+  ''' The name of the main document part, usually word/document.xml
+  '''
+  try:
+    with zf.open('_rels/.rels') as fr:
+      for rel in ET.parse(fr).getroot():
+        if rel.get('Type', '').endswith('/officeDocument'):
+          return rel.get('Target').lstrip('/')
+  except KeyError:
+    pass
+  return 'word/document.xml'
 
 def read_docx_tables(f):
-  ''' This reads tables out of a docx file
+  ''' This reads tables out of a docx file, stream-parsing the document xml and only keeping
+  one top-level table in memory at a time
   '''
-  with contextlib.redirect_stderr(_DevNull()):
-    from docx import Document
-    doc = Document(f)
-  for i, tab in enumerate(doc.tables):
-    yield str(i), _read_docx_tab(tab)
+  with zipfile.ZipFile(f) as zf:
+    with zf.open(_docx_document_part(zf)) as fr:
+      i = 0
+      ancestors = []
+      for event, el in ET.iterparse(fr, events=('start', 'end')):
+        if event == 'start':
+          ancestors.append(el.tag)
+          continue
+        ancestors.pop()
+        if ancestors[-1:] != [_w+'body']: continue
+        # a top-level body element
+        if el.tag == _w+'tbl':
+          yield str(i), _read_docx_tab(el)
+          i += 1
+        el.clear()
 
 @register_ext_handler('.docx')
 def prepare_docx(fr):
-  ''' This calls read_docx_tables, first copying the reader into a ByteIO since
-  tarfile reader doesn't support seeks.
+  ''' This calls read_docx_tables, first copying the reader into a ByteIO if it
+  doesn't support seeks.
+  '''
+  if not fr.seekable():
+    fh = io.BytesIO()
+    shutil.copyfileobj(fr, fh)
+    fh.seek(0)
+    fr = fh
+  yield from read_docx_tables(fr)
+
+def _import_uno():
+  ''' The LibreOffice python bindings, these are typically installed for the system python
+  (i.e. python3-uno), so we also look there. Returns None if they're unavailable.
   '''
-  fh = io.BytesIO()
-  shutil.copyfileobj(fr, fh)
-  fh.seek(0)
-  yield from read_docx_tables(fh)
+  try:
+    import uno
+  except ImportError:
+    if '/usr/lib/python3/dist-packages' in sys.path: return None
+    sys.path.append('/usr/lib/python3/dist-packages')
+    try:
+      import uno
+    except ImportError:
+      return None
+  return uno
+
+class SofficeListener:
+  ''' A long-running headless LibreOffice which accepts conversion requests over a local
+  (UNO) socket, with its own user profile so that concurrent instances don't fight over it.
+  '''
+  def __init__(self, uno, startup_timeout=60):
+    import socket
+    self.profile = tempfile.mkdtemp(prefix='rummagene-soffice-')
+    with socket.socket() as sock:
+      sock.bind(('127.0.0.1', 0))
+      self.port = sock.getsockname()[1]
+    self.proc = subprocess.Popen(
+      [
+        soffice, '--headless', '--invisible', '--nologo', '--nodefault', '--norestore',
+        f"-env:UserInstallation={Path(self.profile).as_uri()}",
+        f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+      ],
+      stderr=subprocess.DEVNULL,
+      stdout=subprocess.DEVNULL,
+      start_new_session=True,
+    )
+    # so it's killed along with this process, when that's stopped before it could close it
+    register_helper(self.proc.pid, self.profile)
+    self.uno = uno
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+    deadline = time.monotonic() + startup_timeout
+    try:
+      while True:
+        try:
+          ctx = resolver.resolve(f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+          break
+        except TimeoutError:
+          # i.e. the member's time budget (see: MemberTimeoutError) ran out while it started up
+          raise
+        except Exception:
+          if self.proc.poll() is not None or time.monotonic() > deadline:
+            raise
+          time.sleep(0.25)
+    except BaseException:
+      self.close()
+      raise
+    self.desktop = ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+
+  def _properties(self, **kwargs):
+    from com.sun.star.beans import PropertyValue
+    properties = []
+    for key, value in kwargs.items():
+      prop = PropertyValue()
+      prop.Name, prop.Value = key, value
+      properties.append(prop)
+    return tuple(properties)
+
+  def _convert(self, src: Path, dst: Path):
+    doc = self.desktop.loadComponentFromURL(src.resolve().as_uri(), '_blank', 0, self._properties(Hidden=True))
+    try:
+      doc.storeToURL(dst.resolve().as_uri(), self._properties(FilterName='MS Word 2007 XML'))
+    finally:
+      doc.close(True)
+
+  def convert(self, src: Path, dst: Path, timeout: int = 60):
+    ''' Convert src to a docx at dst, raising TimeoutError if it takes longer than timeout
+     -- the caller should close this listener in that case.
+    '''
+    _call_in_thread(self._convert, src, dst, timeout=timeout)
+
+  def close(self):
+    import signal
+    try: os.killpg(self.proc.pid, signal.SIGKILL)
+    except ProcessLookupError: pass
+    self.proc.wait()
+    shutil.rmtree(self.profile, ignore_errors=True)
+    unregister_helper(self.proc.pid)
+
+# each worker process keeps its own listener, started on the first .doc it encounters
+_soffice_listener = None
+
+def convert_doc_to_docx(src: Path, dst: Path, timeout: int = 60):
+  ''' Convert a .doc to .docx with a SofficeListener, a listener that fails or hangs is
+  replaced on the next conversion. Without the LibreOffice python bindings we fall
+  back to a one-off `soffice --convert-to` process.
+  '''
+  global _soffice_listener
+  uno = _import_uno()
+  if uno is None:
+    subprocess.call(
+      [soffice, '--headless', '--convert-to', 'docx', str(src)],
+      cwd=src.parent,
+      stderr=subprocess.DEVNULL,
+      stdout=subprocess.DEVNULL,
+      timeout=timeout,
+    )
+    if src.with_suffix('.docx') != dst and src.with_suffix('.docx').exists():
+      shutil.move(src.with_suffix('.docx'), dst)
+    return
+  if _soffice_listener is None:
+    _soffice_listener = SofficeListener(uno)
+    atexit.register(_soffice_listener.close)
+  try:
+    _soffice_listener.convert(src, dst, timeout=timeout)
+  except BaseException as e:
+    if isinstance(e, TimeoutError) or _soffice_listener.proc.poll() is not None:
+      # the listener hung or died, we'll start a new one next time
+      atexit.unregister(_soffice_listener.close)
+      _soffice_listener.close()
+      _soffice_listener = None
+    raise
 
 @register_ext_handler('.doc')
 def read_doc_as_docx(fr):
@@ -114,54 +608,109 @@ def read_doc_as_docx(fr):
     tmpdir = Path(tmpdir)
     with (tmpdir / 'table.doc').open('wb') as fw:
       shutil.copyfileobj(fr, fw)
-    subprocess.call(
-      [soffice, '--headless', '--convert-to', 'docx', str(tmpdir/'table.doc')],
-      cwd=tmpdir,
-      stderr=subprocess.DEVNULL,
-      stdout=subprocess.DEVNULL,
-      timeout=60,
-    )
-    yield from read_docx_tables(tmpdir/'table.docx')
+    start = time.perf_counter()
+    convert_doc_to_docx(tmpdir/'table.doc', tmpdir/'table.docx')
+    package_stats['doc_conversions'] += 1
+    package_stats['doc_conversion_seconds'] += time.perf_counter() - start
+    temp_bytes = sum(f.stat().st_size for f in tmpdir.iterdir())
+    _track_temp_disk(temp_bytes)
+    try:
+      yield from read_docx_tables(tmpdir/'table.docx')
+    finally:
+      _track_temp_disk(-temp_bytes)
+
+# the number of rows/bytes read to decide whether a table is worth parsing in full
+sniff_rows = 500
+sniff_bytes = 1024*1024
+
+def _sniff_gene_columns(df):
+  ''' Whether any column in the first rows of a table contains a gene at all
+  '''
+  return bool(_mappable_genes(pd.unique(df.to_numpy(dtype=object).ravel())).any())
 
 @register_ext_handler('.xls', '.xlsb', '.xlsm','.odf','.ods','.odt')
 def read_excel_tables(f, engine=None):
   ''' Use pandas read_excel function for these files, return all tables from all sheets
+  which have genes in their first rows. The workbook is opened once and for xlsx files
+  (openpyxl) sheets are streamed in read-only mode, so sniffing reads only the first rows.
   '''
-  for sheet, df in pd.read_excel(f, sheet_name=None, engine=engine).items():
-    yield sheet, df
+  with pd.ExcelFile(f, engine=engine) as xl:
+    for sheet in xl.sheet_names:
+      if not _sniff_gene_columns(xl.parse(sheet, nrows=sniff_rows)): continue
+      yield sheet, xl.parse(sheet)
 
 @register_ext_handler('.xlsx')
 def read_xlsx_tables(f):
   yield from read_excel_tables(f, engine='openpyxl')
 
+def _sniff_delimiter(prefix: bytes):
+  ''' Detect the dialect from the first line, like pandas' python engine does for sep=None
+  '''
+  line = prefix.split(b'\n', 1)[0].decode(errors='replace')
+  return csv.Sniffer().sniff(line)
+
+def read_delimited_tables(f, sep=None):
+  ''' Read a delimited text file with the C parser, first parsing only the rows in a byte
+  prefix and reading the rest only if they contain genes. With sep=None the delimiter is
+  detected from the prefix.
+  '''
+  start = f.tell() if f.seekable() else None
+  prefix = f.read(sniff_bytes)
+  kwargs = {}
+  if sep is None:
+    dialect = _sniff_delimiter(prefix)
+    sep = dialect.delimiter
+    kwargs.update(quotechar=dialect.quotechar, doublequote=dialect.doublequote, skipinitialspace=dialect.skipinitialspace)
+  rest = f.read(1)
+  # only parse complete lines from the prefix
+  head = prefix if not rest else prefix[:prefix.rfind(b'\n')+1]
+  if head:
+    try:
+      sniffed = pd.read_csv(io.BytesIO(head), sep=sep, nrows=sniff_rows, **kwargs)
+    except ValueError:
+      # i.e. the prefix ends inside a quoted multi-line field, we can't tell from it
+      sniffed = None
+    if sniffed is not None and not _sniff_gene_columns(sniffed): return
+  if start is not None:
+    # parse it from the file rather than buffering all of it
+    f.seek(start)
+    yield '', pd.read_csv(f, sep=sep, **kwargs)
+  else:
+    yield '', pd.read_csv(io.BytesIO(prefix + rest + f.read()), sep=sep, **kwargs)
+
 @register_ext_handler('.csv')
 def read_csv_tables(f):
-  yield '', pd.read_csv(f)
+  yield from read_delimited_tables(f, sep=',')
 
 @register_ext_handler('.tsv')
 def read_tsv_tables(f):
-  yield '', pd.read_csv(f, sep='\t')
+  yield from read_delimited_tables(f, sep='\t')
 
 @register_ext_handler('.txt')
 def read_txt_tables(f):
-  ''' Try to read txt as a table using pandas infer functionality
+  ''' Try to read txt as a table, inferring the delimiter
   '''
-  yield '', pd.read_csv(f, sep=None, engine='python')
+  yield from read_delimited_tables(f)
 
 def _read_xml_text(node):
   ''' Read the text from an xml node (or the text from all it's children)
   '''
   return re.sub(r'\s+', ' ', ''.join(node.itertext()) if node is not None else '', 0, re.MULTILINE).strip()
 
+def _itertext_with_exclusion(node, exclude):
+  ''' Like node.itertext() but skipping over (and after) the descendants with an excluded tag
+  '''
+  if not isinstance(node.tag, str) and node.tag is not None: return
+  if node.text: yield node.text
+  for child in node:
+    if child.tag in exclude: continue
+    yield from _itertext_with_exclusion(child, exclude)
+    if child.tail: yield child.tail
+
 def _read_xml_text_with_exclusion(node, exclude={'table-wrap', 'fig'}):
   ''' Read the text from an xml node (or the text from all it's children)
   '''
-  import copy
-  node = copy.deepcopy(node)
-  for excl in exclude:
-    for el in node.findall(f".//{excl}"):
-      el.clear()
-  return _read_xml_text(node)
+  return re.sub(r'\s+', ' ', ''.join(_itertext_with_exclusion(node, exclude)), 0, re.MULTILINE).strip()
 
 
 def _read_xml_table(tbl):
@@ -204,28 +753,42 @@ def match_parens(text):
     text = text[:closeParen] + text[closeParen+1:]
   return text
 
+def _iter_xml_children(node):
+  ''' Yield (parent, child) for all descendants of node in document order
+  '''
+  for child in node:
+    yield node, child
+    yield from _iter_xml_children(child)
+
+@functools.lru_cache(maxsize=1)
+def _index_xml_mentions(root):
+  ''' Index the first paragraph mentioning each reference in one pass over the document,
+  rid => (paragraph text, reference text)
+  '''
+  index = {}
+  visited = set()
+  for xrefParentNode, xref in _iter_xml_children(root):
+    if xref.tag != 'xref' or 'rid' not in xref.attrib or xrefParentNode in visited: continue
+    visited.add(xrefParentNode)
+    mention = _read_xml_text_with_exclusion(xrefParentNode)
+    if not mention: continue
+    for xrefNode in xrefParentNode.findall('xref'):
+      ref = xrefNode.attrib.get('rid')
+      if ref is not None and ref not in index:
+        index[ref] = (mention, _read_xml_text(xrefNode))
+  return index
+
 def _read_xml_mentions(root, ref: str):
   if not ref:
     return ''
-  try:
-    # get the first parent paragraph mentioning the reference
-    xrefParentNode, mention = next(iter(
-      (xrefParentNode, mention)
-      # for xrefParentNode in root.findall(f".//xref[@rid='{ref}']/..")
-      for xrefParentNode in root.findall(f".//xref[@rid]/..")
-      if any(xref.attrib['rid'] == ref for xref in xrefParentNode.findall('xref'))
-      for mention in (_read_xml_text_with_exclusion(xrefParentNode),)
-      if mention
-    ))
-    # get the reference text
-    xrefNode = next(iter(xrefNode for xrefNode in xrefParentNode.findall('xref') if xrefNode.attrib['rid'] == ref))
-    xrefNodeText = _read_xml_text(xrefNode)
-    # read up to the reference (encased in parens/brackets)
-    indexOfRef = mention.index(xrefNodeText)
-    # get at most 20 words before the reference
-    return match_parens(' '.join(re.split(r'\s+', mention[:indexOfRef])[-15:]) + '**'+' '.join(re.split(r'\s+', xrefNodeText))+'**')
-  except StopIteration:
+  # get the first parent paragraph mentioning the reference & the reference text
+  mention, xrefNodeText = _index_xml_mentions(root).get(ref, ('', None))
+  if not mention:
     return ''
+  # read up to the reference (encased in parens/brackets)
+  indexOfRef = mention.index(xrefNodeText)
+  # get at most 20 words before the reference
+  return match_parens(' '.join(re.split(r'\s+', mention[:indexOfRef])[-15:]) + '**'+' '.join(re.split(r'\s+', xrefNodeText))+'**')
 
 def _read_xml_tables(root, member_path: PurePosixPath):
   ''' Tables are embedded in the xml files, they can be parsed 
@@ -236,9 +799,11 @@ def _read_xml_tables(root, member_path: PurePosixPath):
     tbl = tblWrap.find('./table')
     if tbl and tbl.find('./thead') and tbl.find('./tbody'):
       try:
-        df = _read_xml_table(tbl)
+        with _stage('xml_tables'):
+          df = _read_xml_table(tbl)
         # extract any gene set columns
-        gene_sets.extend(extract_gene_set_columns(df))
+        with _stage('gene_set_columns'):
+          gene_sets.extend(extract_gene_set_columns(df))
       except KeyboardInterrupt:
         raise
       except:
@@ -253,8 +818,44 @@ def _read_xml_tables(root, member_path: PurePosixPath):
       for column, gene_set in gene_sets:
         yield f"{member_path.parent.name}-{member_path.name}-{slugify(label)}-{slugify(column)}", description, gene_set
 
-def _read_xml_supplement(tar: tarfile.TarFile, root: ET.Element):
-  members = {member_name.name: (member_name, member) for member in tar.getmembers() for member_name in (PurePosixPath(member.name),)}
+def _read_xml_hrefs(root: ET.Element):
+  ''' The file names of all supplementary media referenced by the xml
+  '''
+  return {
+    media.attrib['{http://www.w3.org/1999/xlink}href']
+    for media in root.findall('.//supplementary-material/media')
+    if '{http://www.w3.org/1999/xlink}href' in media.attrib
+  }
+
+class MemberTimeoutError(TimeoutError):
+  pass
+
+@contextlib.contextmanager
+def _time_budget(seconds):
+  ''' Raise MemberTimeoutError in the block once it's taken more than `seconds`. This relies on
+  SIGALRM, so it only applies on a process's main thread (where worker tasks run).
+  '''
+  import signal
+  if not seconds or threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'setitimer'):
+    yield
+    return
+  def alarm(signum, frame):
+    raise MemberTimeoutError()
+  previous = signal.signal(signal.SIGALRM, alarm)
+  signal.setitimer(signal.ITIMER_REAL, seconds)
+  try:
+    yield
+  finally:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, previous)
+
+def _read_xml_supplement(members: dict, root: ET.Element):
+  ''' members: a mapping from file name to (member_path, file handle) of the package
+
+  Each member is handled within member_timeout, members which take longer are skipped.
+  The results of members are looked up in/stored to the supplement_cache when there is one.
+  '''
+  global current_member
   for supplementary_material in root.findall('.//supplementary-material'):
     gene_sets = []
     supplementary_material_caption = _read_xml_text(supplementary_material.find('./caption')).rstrip('.')
@@ -265,10 +866,50 @@ def _read_xml_supplement(tar: tarfile.TarFile, root: ET.Element):
       member_name, member = members[href]
       handler = ext_handlers.get(member_name.suffix.lower())
       if not handler: continue
-      media_gene_sets = []
-      for sheet, df in handler(tar.extractfile(member)):
-        for column, gene_set in extract_gene_set_columns(df):
-          media_gene_sets.append((f"{slugify(sheet)}-{slugify(column)}", gene_set))
+      member_bytes = member.seek(0, io.SEEK_END)
+      member.seek(0)
+      media_gene_sets = None
+      if supplement_cache is not None:
+        with _stage('cache'):
+          cache_key = content_key(member, supplement_cache_version, member_name.suffix.lower(), open_lookup().digest, pdf_min_page_genes)
+          media_gene_sets = supplement_cache.get(cache_key)
+        package_stats['cache_misses' if media_gene_sets is None else 'cache_hits'] += 1
+      if media_gene_sets is not None:
+        member_stats = dict(member=str(member_name), status='cached', seconds=0.)
+        package_members.append(member_stats)
+        emit_partial(('member', member_stats))
+      else:
+        media_gene_sets = []
+        current_member = str(member_name)
+        status = 'error'
+        start = time.perf_counter()
+        try:
+          with _time_budget(member_timeout), _stage(f"handler{member_name.suffix.lower()}"):
+            for sheet, df in handler(member):
+              with _stage('gene_set_columns'):
+                for column, gene_set in extract_gene_set_columns(df):
+                  media_gene_sets.append((f"{slugify(sheet)}-{slugify(column)}", gene_set))
+          status = 'ok'
+        except TimeoutError:
+          # ran out of the member budget, or a handler's own time limit (i.e. a pdf or .doc
+          #  conversion), only this member is dropped. Whatever we interrupted may be left in
+          #  a bad state, don't re-use this worker
+          request_recycle()
+          status = 'timeout'
+          media_gene_sets = []
+        finally:
+          current_member = None
+          seconds = time.perf_counter() - start
+          handler_stats = package_handlers.setdefault(member_name.suffix.lower(), dict(members=0, bytes=0, seconds=0.))
+          handler_stats['members'] += 1
+          handler_stats['bytes'] += member_bytes
+          handler_stats['seconds'] += seconds
+          member_stats = dict(member=str(member_name), status=status, seconds=seconds)
+          package_members.append(member_stats)
+          emit_partial(('member', member_stats))
+        if supplement_cache is not None and status == 'ok':
+          with _stage('cache'):
+            supplement_cache.put(cache_key, media_gene_sets)
       #
       if media_gene_sets:
         media_caption = _read_xml_text(media.find('./caption')).rstrip('.')
@@ -282,63 +923,239 @@ def _read_xml_supplement(tar: tarfile.TarFile, root: ET.Element):
         description = '  '.join(filter(None, (mention, caption,)))
         yield term, description, gene_set
 
-def extract_tables_from_xml(tar: tarfile.TarFile, member_path: PurePosixPath, f):
-  parsed = ET.parse(f)
-  root = parsed.getroot()
+def extract_tables_from_xml(members: dict, member_path: PurePosixPath, root: ET.Element):
   yield from _read_xml_tables(root, member_path)
-  yield from _read_xml_supplement(tar, root)
+  yield from _read_xml_supplement(members, root)
+
+# options for the JVM tabula runs on, these only take effect when a worker's JVM is started
+tabula_java_options = ['-Xmx2g']
+
+# pages with fewer distinct gene-like tokens than this are not sent to tabula (0 to read all pages)
+pdf_min_page_genes = 3
+
+def _pdf_candidate_pages(path, min_page_genes=3):
+  ''' A cheap first pass over the text layer of the pdf, scoring each page by the number of
+  distinct tokens that map to genes. Tables are extracted per page and a gene set column
+  needs 5+ unique values, more than half of them genes, so pages with fewer than 3 can't
+  produce one. Returns the (1-based) candidate pages and the seconds spent screening each page.
+  '''
+  from pypdf import PdfReader
+  reader = PdfReader(path)
+  pages = []
+  page_seconds = []
+  for page_number, page in enumerate(reader.pages, 1):
+    start = time.perf_counter()
+    try:
+      text = page.extract_text()
+    except MemberTimeoutError:
+      raise
+    except Exception:
+      # can't tell, let tabula have a look
+      pages.append(page_number)
+      page_seconds.append(time.perf_counter() - start)
+      continue
+    tokens = set()
+    for token in text.split():
+      tokens.add(token)
+      tokens.add(token.strip('.,;:()[]{}"\''))
+    if _mappable_genes(list(tokens)).sum() >= min_page_genes:
+      pages.append(page_number)
+    page_seconds.append(time.perf_counter() - start)
+  return pages, page_seconds
+
+def _read_pdf_pages(path, pages):
+  ''' Read the tables on the given pages of the pdf, in one call so tabula only loads the document once
+  '''
+  if not pages: return []
+  import tabula
+  tables = tabula.read_pdf(
+    path, pages=pages, multiple_tables=True, silent=True,
+    java_options=tabula_java_options, force_subprocess=False,
+  )
+  if type(tables) != list:
+    raise NotImplementedError()
+  return tables
+
+def read_pdf_document(path, timeout: int = 60*2, min_page_genes: int = None):
+  ''' Read the tables of a pdf with tabula on this process's long-lived JVM (through jpype),
+  rather than forking a new JVM for each one. Only the pages passing the _pdf_candidate_pages
+  pre-screen are read. Returns (tables, timing), tables is the exception instead if it failed.
+  The timing has the seconds of the document, of the pre-screen of each page (screen_seconds)
+  & of tabula per page read (tabula_page_seconds, they're read in one call).
+
+  The JVM can't be interrupted, so a pdf taking longer than timeout is abandoned and the worker
+   is flagged for recycling.
+  '''
+  start = time.perf_counter()
+  timing = dict(
+    handler='pdf', member=current_member, pages=None, pages_skipped=None,
+    screen_seconds=None, tabula_seconds=None, tabula_page_seconds=None,
+  )
+  min_page_genes = pdf_min_page_genes if min_page_genes is None else min_page_genes
+  try:
+    try:
+      pages, screen_seconds = _pdf_candidate_pages(path, min_page_genes)
+      timing.update(pages=len(pages), pages_skipped=len(screen_seconds) - len(pages), screen_seconds=screen_seconds)
+    except MemberTimeoutError:
+      raise
+    except Exception:
+      # couldn't read the pdf ourselves, let tabula try to read all the pages at once
+      pages = 'all'
+    tabula_start = time.perf_counter()
+    tables = _call_in_thread(_read_pdf_pages, path, pages, timeout=timeout)
+    tabula_seconds = time.perf_counter() - tabula_start
+    timing.update(tabula_seconds=tabula_seconds)
+    if pages != 'all' and pages:
+      timing.update(tabula_page_seconds=tabula_seconds / len(pages))
+  except MemberTimeoutError:
+    raise
+  except TimeoutError as e:
+    request_recycle()
+    tables = e
+  except Exception as e:
+    tables = e
+  timing['seconds'] = time.perf_counter() - start
+  return tables, timing
 
 @register_ext_handler('.pdf')
 def read_pdf_tables(f):
   ''' pdf tables read by tabula library
   '''
-  import tabula
-  results = tabula.read_pdf(f, pages='all', multiple_tables=True, silent=True)
-  if type(results) == list:
-    for i, df in enumerate(results):
-      yield f"{i}", df
-  elif type(results) == dict:
-    for key, df in results.items():
-      yield key, df
-  else:
-    raise NotImplementedError()
+  with tempfile.NamedTemporaryFile(prefix='rummagene-', suffix='.pdf') as tmp:
+    shutil.copyfileobj(f, tmp)
+    tmp.flush()
+    _track_temp_disk(tmp.tell())
+    try:
+      tables, timing = read_pdf_document(tmp.name)
+    finally:
+      _track_temp_disk(-tmp.tell())
+  package_stats['pdf_documents'] += 1
+  package_stats['pdf_seconds'] += timing['seconds']
+  package_stats['pdf_pages'] += timing['pages'] or 0
+  package_stats['pdf_pages_skipped'] += timing['pages_skipped'] or 0
+  package_timings.append(timing)
+  if isinstance(tables, Exception):
+    raise tables
+  for i, df in enumerate(tables):
+    yield f"{i}", df
+
+class _CountingReader:
+  ''' File handle wrapper which counts the bytes read through it
+  '''
+  def __init__(self, fr):
+    self.fr = fr
+    self.bytes_read = 0
+  def read(self, *args):
+    buf = self.fr.read(*args)
+    self.bytes_read += len(buf)
+    return buf
+
+def extract_gmt_from_oa_package(oa_package, spool_budget=64*1024*1024):
+  ''' Given a oa_package (open access bundle with paper & figures, a path or a file handle with the
+   .tar.gz) extract all applicable gene sets from all applicable tables
+
+  The tar.gz is walked as a stream so it's only decompressed once (seeking around a gzip stream
+   decompresses it from the start again). Supplementary files are spooled until we get to the
+   xml, after which we only keep the ones it actually references. They're kept in memory for
+   as long as the package's spool_budget allows, the rest go to disk.
+  '''
+  xmls = []
+  referenced = None
+  members = {}
+  spooled_in_memory = 0
+  with contextlib.ExitStack() as stack:
+    fr = stack.enter_context(gzip.open(oa_package, 'rb'))
+    decompressed = _CountingReader(fr)
+    tar = stack.enter_context(tarfile.open(fileobj=decompressed, mode='r|'))
+    with _stage('tar_walk'):
+      for member in tar:
+        if not member.isfile(): continue
+        member_path = PurePosixPath(member.name)
+        suffix = member_path.suffix.lower()
+        if suffix in ('.nxml', '.xml'):
+          with _stage('xml_parse'):
+            root = ET.parse(tar.extractfile(member)).getroot()
+            xmls.append((member_path, root))
+            referenced = (referenced or set()) | _read_xml_hrefs(root)
+        elif suffix in ext_handlers and (referenced is None or member_path.name in referenced):
+          # max_size=0, it only goes to disk when we say so
+          spool = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=0, prefix='rummagene-'))
+          if spooled_in_memory + member.size > spool_budget:
+            spool.rollover()
+            _track_temp_disk(member.size)
+            stack.callback(_track_temp_disk, -member.size)
+          else:
+            spooled_in_memory += member.size
+          shutil.copyfileobj(tar.extractfile(member), spool)
+          members[member_path.name] = (member_path, spool)
+          package_stats['bytes_spooled'] += member.size
+    package_stats['bytes_decompressed'] += decompressed.bytes_read
+    members = {name: member for name, member in members.items() if name in (referenced or set())}
+    for member_path, root in xmls:
+      with _stage('xml_extract'):
+        yield from extract_tables_from_xml(members, member_path, root)
 
-def extract_gmt_from_oa_package(oa_package):
-  ''' Given a oa_package (open access bundle with paper & figures) extract all applicable gene sets
-   from all applicable tables
-  '''
-  with tarfile.open(oa_package) as tar:
-    for member in tar.getmembers():
-      if not member.isfile(): continue
-      member_path = PurePosixPath(member.name)
-      if member_path.suffix.lower() not in ('.nxml', '.xml'): continue
-      yield from extract_tables_from_xml(tar, member_path, tar.extractfile(member))
-
-lookup = None
-def gene_lookup(value):
-  ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
-  '''
-  if type(value) != str: return None
-  if re.search(r'\s', value): return None
-  if re.match(r'\d+(\.\d+)?', value): return None
-  global lookup
-  if lookup is None:
-    import json
-    with open('lookup.json', 'r') as fr:
-      lookup = json.load(fr).get
-  return lookup(value)
-
-def extract_gene_set_columns(df):
+def _warm_worker(java_options=None, min_page_genes=None, member_seconds=None, cache_path=None, cache_size=None):
+  ''' Apply the settings of main to a worker process & pay for the slow imports & the gene
+  lookup once, when a WorkerPool process starts (or before each run_with_timeout task)
+  '''
+  global pdf_min_page_genes, member_timeout, supplement_cache
+  if java_options is not None:
+    tabula_java_options[:] = java_options
+  if min_page_genes is not None:
+    pdf_min_page_genes = min_page_genes
+  if member_seconds is not None:
+    member_timeout = member_seconds
+  if cache_path is not None and cache_size:
+    supplement_cache = open_cache(cache_path, cache_size)
+  import openpyxl
+  open_lookup()
+
+def _mappable_genes(values):
+  ''' A vectorized gene_lookup, returns a boolean mask of the values which map to a gene
+  '''
+  values = np.asarray(values, dtype=object)
+  mask = np.fromiter((type(value) == str for value in values), dtype=bool, count=len(values))
+  if mask.any():
+    strs = pd.Series(values[mask], dtype=object)
+    mask[mask] = ~(strs.str.contains(r'\s').to_numpy(dtype=bool) | strs.str.match(r'\d+(\.\d+)?').to_numpy(dtype=bool))
+  if mask.any():
+    mask[mask] = open_lookup().contains_many(values[mask].tolist())
+  return mask
+
+def extract_gene_set_columns(df, sample_size=500):
   ''' Given a pandas dataframe, find columns containing mostly mappable genes
+
+  All object columns are screened in one batch on a sample of (at most sample_size of) their
+   unique values, only the columns that pass are then mapped in full.
   '''
-  for col in df.columns:
-    if df[col].dtype != np.dtype('O'): continue
-    unique_genes = pd.Series(df[col].dropna().unique())
+  columns = []
+  for col, values in df.items():
+    if values.dtype != np.dtype('O'): continue
+    unique_genes = pd.Series(values.dropna().unique())
     if unique_genes.shape[0] >= 5:
-      unique_genes_mapped = unique_genes.apply(gene_lookup).dropna()
-      ratio = unique_genes_mapped.shape[0] / unique_genes.shape[0]
-      if ratio > 0.5:
-        yield col, unique_genes.apply(lambda gene: re.sub(r'\s+', ' ', gene) if type(gene) == str else gene).tolist()
+      columns.append((col, unique_genes))
+  if not columns: return
+  # screen the samples of all columns at once
+  sample_mapped = _mappable_genes(np.concatenate([unique_genes.values[:sample_size] for _, unique_genes in columns]))
+  candidates = []
+  offset = 0
+  for col, unique_genes in columns:
+    n_sample = min(sample_size, unique_genes.shape[0])
+    n_sample_mapped = sample_mapped[offset:offset+n_sample].sum()
+    offset += n_sample
+    if n_sample_mapped / n_sample > 0.5:
+      candidates.append((col, unique_genes, n_sample_mapped))
+  # map the remainder of columns which passed on their sample
+  remainders = [unique_genes.values[sample_size:] for _, unique_genes, _ in candidates]
+  remainder_mapped = _mappable_genes(np.concatenate(remainders)) if candidates else np.array([], dtype=bool)
+  offset = 0
+  for (col, unique_genes, n_sample_mapped), remainder in zip(candidates, remainders):
+    n_mapped = n_sample_mapped + remainder_mapped[offset:offset+len(remainder)].sum()
+    offset += len(remainder)
+    ratio = n_mapped / unique_genes.shape[0]
+    if ratio > 0.5:
+      yield col, unique_genes.apply(lambda gene: re.sub(r'\s+', ' ', gene) if type(gene) == str else gene).tolist()
 
 def slugify(s):
   ''' Replace non-characters/numbers with _
@@ -356,7 +1173,10 @@ def fetch_oa_file_list(data_dir = Path()):
     ts_col = df.columns[-3]
     df[ts_col] = pd.to_datetime(df[ts_col])
     df.sort_values(ts_col, ascending=False, inplace=True)
-    df.to_csv(oa_file_list, index=None)
+    # written atomically, shards running side by side might fetch it at the same time
+    tmp = oa_file_list.with_name(f"{oa_file_list.name}.{os.getpid()}.tmp")
+    df.to_csv(tmp, index=None)
+    os.replace(tmp, oa_file_list)
   else:
     df = pd.read_csv(oa_file_list)
   return df
@@ -383,45 +1203,457 @@ def find_pmc_ids(term):
       traceback.print_exc()
       break
 
+def shard_of(oa_package, shards):
+  ''' The shard an oa_package belongs to, by a hash of its name which is stable across processes
+  & machines so that every shard agrees on the partition
+  '''
+  import hashlib
+  return int.from_bytes(hashlib.sha1(oa_package.encode()).digest()[:8], 'big') % shards
+
 def filter_oa_file_list_by(oa_file_list, pmc_ids):
   ''' Filter oa_file_list by PMC IDs
   '''
   return oa_file_list[oa_file_list['Accession ID'].isin(list(pmc_ids))]
 
-def fetch_extract_gmt_from_oa_package(oa_package):
-  ''' Given the oa_package name from the oa_file_list, we'll download it temporarily and then extract a gmt out of it
+efetch_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+
+def _read_article_listing(article: ET.Element):
+  ''' The extensions of the supplementary files an article references & the number of gene sets
+  in its tables, what it takes to tell whether its package could yield gene sets
   '''
-  with tempfile.NamedTemporaryFile(prefix='rummagene-', suffix=''.join(PurePosixPath(oa_package).suffixes)) as tmp:
-    with urllib.request.urlopen(f"https://ftp.ncbi.nlm.nih.gov/pub/pmc/deprecated/{oa_package}") as fr:
-      shutil.copyfileobj(fr, tmp)
-    tmp.flush()
-    return list(extract_gmt_from_oa_package(tmp.name))
+  extensions = {PurePosixPath(href).suffix.lower() for href in _read_xml_hrefs(article)}
+  gene_tables = sum(1 for _ in _read_xml_tables(article, PurePosixPath('article.nxml')))
+  return extensions, gene_tables
+
+def fetch_article_listings(session, accessions, efetch_url=efetch_url):
+  ''' Fetch the xml of a batch of articles (PMC accessions) with efetch, returns the listing
+  (see: _read_article_listing) of each one we got the full text of
+  '''
+  params = dict(db='pmc', retmode='xml', id=','.join(accession.removeprefix('PMC') for accession in accessions))
+  if os.environ.get('API_KEY'): params['api_key'] = os.environ['API_KEY']
+  if os.environ.get('EMAIL'): params['email'] = os.environ['EMAIL']
+  res = session.get(efetch_url, params=params, timeout=120)
+  res.raise_for_status()
+  root = ET.fromstring(res.content)
+  listings = {}
+  for article in root.iter('article'):
+    article_ids = {
+      article_id.attrib.get('pub-id-type'): (article_id.text or '').strip()
+      for article_id in article.findall('./front/article-meta/article-id')
+    }
+    pmc = article_ids.get('pmc') or article_ids.get('pmcid')
+    if not pmc: continue
+    # without the full text we can't tell
+    if article.find('./body') is None: continue
+    listings[pmc if pmc.startswith('PMC') else f"PMC{pmc}"] = _read_article_listing(article)
+  return listings
+
+def prefilter_oa_packages(ledger, packages, efetch_url=efetch_url, batch_size=100, shards=1):
+  ''' Split packages, (oa_package, accession) pairs, into those which could yield gene sets and
+  those which can't: the ones with neither supplementary files we have a handler for nor gene
+  sets in their tables. Listings are cached in the ledger, the rest are fetched with efetch.
+  Packages we can't tell about (including those without an accession) are kept.
+
+  The E-utilities rate limit is shared by the `shards` processes prefiltering side by side.
+  '''
+  listings = ledger.listings(accession for _, accession in packages if accession is not None)
+  missing = list(dict.fromkeys(accession for _, accession in packages if accession is not None and accession not in listings))
+  with requests.Session() as session:
+    for i in tqdm.tqdm(range(0, len(missing), batch_size), desc='Fetching article listings...'):
+      try:
+        fetched = fetch_article_listings(session, missing[i:i+batch_size], efetch_url)
+      except Exception:
+        traceback.print_exc()
+        continue
+      ledger.save_listings(fetched)
+      listings.update(fetched)
+      # stay within the E-utilities rate limit, our share of it with shards
+      time.sleep((0.1 if os.environ.get('API_KEY') else 0.34) * shards)
+  promising, unpromising = [], []
+  for oa_package, accession in packages:
+    if accession not in listings:
+      promising.append(oa_package)
+      continue
+    extensions, gene_tables = listings[accession]
+    if gene_tables or any(extension in ext_handlers for extension in extensions):
+      promising.append(oa_package)
+    else:
+      unpromising.append(oa_package)
+  return promising, unpromising
 
-def task(record):
+oa_package_base_url = 'https://ftp.ncbi.nlm.nih.gov/pub/pmc/deprecated/'
+
+def fetch_oa_package(session, oa_package, base_url=oa_package_base_url):
+  ''' Download the oa_package into a temporary file using a (keep-alive) requests session,
+  the caller is responsible for removing the file.
+  '''
+  fd, path = tempfile.mkstemp(prefix='rummagene-', suffix=''.join(PurePosixPath(oa_package).suffixes))
   try:
-    return record, None, run_with_timeout(fetch_extract_gmt_from_oa_package, record['File'], timeout=60*5)
-  except KeyboardInterrupt:
-    raise
+    with os.fdopen(fd, 'wb') as fw:
+      with session.get(base_url + oa_package, stream=True, timeout=60) as res:
+        res.raise_for_status()
+        for chunk in res.iter_content(chunk_size=1024*1024):
+          fw.write(chunk)
   except:
-    return record, traceback.format_exc(), None
+    os.unlink(path)
+    raise
+  return path
+
+def _extract_oa_package(oa_package):
+  package_stats.clear()
+  package_timings.clear()
+  package_handlers.clear()
+  package_members.clear()
+  package_stages.clear()
+  _stage_stack.clear()
+  gene_sets = []
+  for gene_set in extract_gmt_from_oa_package(oa_package):
+    gene_sets.append(gene_set)
+    emit_partial(('gene_set', gene_set))
+  package_stats['member_timeouts'] = sum(member['status'] == 'timeout' for member in package_members)
+  del package_stats['temp_disk']
+  return gene_sets
+
+def extract_oa_package_file(path):
+  ''' Extract the gmt from a downloaded oa_package, returns the gene sets and the package_stats.
+  The gene sets & member outcomes are also streamed to the parent as they're ready (see: emit_partial)
+  '''
+  gene_sets = _extract_oa_package(path)
+  package_stats['bytes_compressed'] = os.path.getsize(path)
+  return gene_sets, dict(package_stats, timings=list(package_timings), handlers=dict(package_handlers), members=list(package_members), stages=dict(package_stages))
+
+def extract_oa_package_url(url):
+  ''' Like extract_oa_package_file, but the oa_package is extracted as it's downloaded
+  rather than from a downloaded copy
+  '''
+  with requests.get(url, stream=True, timeout=60) as res:
+    res.raise_for_status()
+    # undo any transfer encoding, we want the .tar.gz as is
+    res.raw.decode_content = True
+    compressed = _CountingReader(res.raw)
+    gene_sets = _extract_oa_package(compressed)
+    package_stats['bytes_compressed'] = compressed.bytes_read
+  return gene_sets, dict(package_stats, timings=list(package_timings), handlers=dict(package_handlers), members=list(package_members), stages=dict(package_stages))
+
+def fetch_extract_gmt_from_oa_package(oa_package, base_url=oa_package_base_url):
+  ''' Given the oa_package name from the oa_file_list, we'll download it temporarily and then extract a gmt out of it
+  '''
+  with requests.Session() as session:
+    path = fetch_oa_package(session, oa_package, base_url)
+  try:
+    gene_sets, _ = extract_oa_package_file(path)
+    return gene_sets
+  finally:
+    os.unlink(path)
+
+class CostModel:
+  ''' An online estimate of the seconds it takes to extract a package: a fixed overhead plus
+  a rate (seconds per byte of the compressed package) for each type of supplementary file it
+  has. Both are exponentially weighted moving averages of what the workers report (see:
+  package_handlers).
 
-def main(data_dir = Path(), oa_file_list = None, progress = 'done.txt', progress_output = 'done.new.txt', output = 'output.gmt'):
+  The package's members aren't looked at before it's scheduled (that'd take another pass over
+  the gzip stream), the types of its supplementary files are those its article lists (see:
+  prefilter_oa_packages). When the listing isn't known all we know is the package's size,
+  '.tar.gz' is the rate of the package as a whole.
   '''
-  Work through oa_file_list (see: fetch_oa_file_list)
-    -- you can filter it and provide it to this function
-  Track progress by storing oa_packages already processed in done.txt
+  # the rates were per byte of the members, saved costs of an older version are dropped
+  version = 2
+  # rough priors, tabula & the doc conversion are much slower than reading text formats
+  default_overhead = 0.5
+  default_rates = {'.pdf': 2e-6, '.doc': 2e-7, '.xls': 1e-7, '.xlsx': 1e-7, '.docx': 5e-8, '.tar.gz': 1e-6}
+  default_rate = 1e-8
+
+  def __init__(self, overhead=None, rates=None, alpha=0.05):
+    self.alpha = alpha
+    self.overhead = self.default_overhead if overhead is None else overhead
+    self.rates = dict(self.default_rates, **(rates or {}))
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def package_bytes(n_bytes: int, extensions=None):
+    ''' What a package's cost is estimated from: its compressed size for each type of supplementary
+    file (with a handler) its article lists, or for the package as a whole without a listing
+    '''
+    if extensions is None: return {'.tar.gz': n_bytes}
+    return {ext: n_bytes for ext in extensions if ext in ext_handlers}
+
+  def estimate(self, package_bytes: dict):
+    with self._lock:
+      return self.overhead + sum(self.rates.get(ext, self.default_rate) * n_bytes for ext, n_bytes in package_bytes.items())
+
+  def update(self, seconds: float, stats: dict):
+    ''' Update the estimates with the seconds a package took and the stats it reported
+    '''
+    with self._lock:
+      handler_seconds = 0
+      for ext, handler_stats in stats['handlers'].items():
+        handler_seconds += handler_stats['seconds']
+        if not stats['bytes_compressed']: continue
+        rate = self.rates.get(ext, self.default_rate)
+        self.rates[ext] = rate + self.alpha * (handler_stats['seconds'] / stats['bytes_compressed'] - rate)
+      if stats['bytes_compressed']:
+        rate = self.rates.get('.tar.gz', self.default_rate)
+        self.rates['.tar.gz'] = rate + self.alpha * (max(seconds - self.overhead, 0) / stats['bytes_compressed'] - rate)
+      self.overhead += self.alpha * (max(seconds - handler_seconds, 0) - self.overhead)
+
+  def update_timeout(self, timeout: float, package_bytes: dict):
+    ''' A package didn't finish in timeout seconds, scale up the rates it involved so that
+    similar packages are estimated to take at least that long
+    '''
+    estimate = self.estimate(package_bytes)
+    if estimate >= timeout or not package_bytes: return
+    with self._lock:
+      for ext in package_bytes:
+        rate = self.rates.get(ext, self.default_rate)
+        self.rates[ext] = rate + self.alpha * (rate * timeout / estimate - rate)
+
+def pipeline(
+  records, run=run_with_timeout, download_workers=4, parse_workers=None, queue_size=None, base_url=oa_package_base_url, timeout=60*5,
+  cost_model=None, big_cost=60, big_workers=None, big_timeout=None, stream=False, io_stats=None,
+):
+  ''' Fetch and extract gmts from oa_packages in two independent stages:
+   - `download_workers` threads, each with its own keep-alive session, size (HEAD) & download
+     packages, up to their lane's (see below) share of `queue_size` fetched archives waiting
+   - `parse_workers` threads hand the fetched archives to `run` (i.e. a WorkerPool)
+  This way a slow transfer doesn't hold up a parse slot and vice versa, only the parse
+   is subject to `timeout` (or the record's own 'timeout').
+
+  Fetched archives are scheduled by their estimated cost (see: CostModel), from their size & the
+   record's 'extensions' when its article's listing is known: packages estimated to take more
+   than `big_cost` seconds (and retries) go to a separate lane of `big_workers` parse threads
+   with `big_timeout`, so they can't hold up the small ones. Each lane runs its cheapest package
+   first, and has its own share of `queue_size` (by its number of workers). A package whose lane
+   has no slot free is set aside (before it's downloaded) while the downloaders carry on with the
+   next ones, so a burst of big packages can't hold up the small ones.
+
+  With `stream`, packages aren't downloaded up front: the downloaders only size them and the
+   worker extracts the package as it downloads it (see: extract_oa_package_url), the timeout
+   then includes the transfer.
+
+  Yields (record, err, res) as packages complete, with the record's download_seconds, bytes,
+   cost, lane & seconds filled in where known. The bytes written to & peak disk usage of the
+   downloaded packages are counted in `io_stats`.
+  '''
+  parse_workers = parse_workers or os.cpu_count()
+  big_workers = big_workers or max(1, parse_workers // 4)
+  lanes = dict(
+    small=dict(workers=max(1, parse_workers - big_workers), timeout=timeout),
+    big=dict(workers=big_workers, timeout=big_timeout or 3*timeout),
+  )
+  cost_model = cost_model or CostModel()
+  records = iter(records)
+  records_lock = threading.Lock()
+  fetched = {lane: queue.PriorityQueue() for lane in lanes}
+  queue_size = queue_size or 2*parse_workers
+  lane_workers = sum(lane['workers'] for lane in lanes.values())
+  for lane in lanes.values():
+    lane['slots'] = threading.BoundedSemaphore(max(1, queue_size * lane['workers'] // lane_workers))
+  # sized records whose lane had no slot free
+  deferred = {lane: collections.deque() for lane in lanes}
+  sequence = itertools.count()
+  results = queue.Queue()
+  io_stats = collections.Counter() if io_stats is None else io_stats
+  io_stats_lock = threading.Lock()
+
+  def track_download_disk(n_bytes):
+    with io_stats_lock:
+      io_stats['download_disk'] += n_bytes
+      io_stats['download_disk_peak'] = max(io_stats['download_disk_peak'], io_stats['download_disk'])
+      if n_bytes > 0:
+        io_stats['download_bytes_written'] += n_bytes
+
+  def next_record():
+    ''' The next (record, lane, slot): a record set aside for its lane once that has a slot free,
+    else the next one to size (lane None), else one set aside (waiting for a slot)
+    '''
+    with records_lock:
+      for lane, waiting in deferred.items():
+        if waiting and lanes[lane]['slots'].acquire(blocking=False):
+          return waiting.popleft(), lane, True
+      record = next(records, None)
+      if record is not None:
+        return record, None, False
+      for lane, waiting in deferred.items():
+        if waiting:
+          return waiting.popleft(), lane, False
+    return None, None, False
+
+  def download():
+    with requests.Session() as session:
+      while True:
+        record, lane, slot = next_record()
+        if record is None: break
+        try:
+          if lane is None:
+            # size it first, it's only downloaded once its lane has room for it
+            with session.head(base_url + record['File'], allow_redirects=True, timeout=60) as res:
+              res.raise_for_status()
+              n_bytes = int(res.headers.get('Content-Length', 0))
+            package_bytes = CostModel.package_bytes(n_bytes, record.get('extensions'))
+            cost = cost_model.estimate(package_bytes)
+            lane = 'big' if cost > big_cost or 'timeout' in record else 'small'
+            record = dict(record, package_bytes=package_bytes, cost=cost, lane=lane)
+            slot = lanes[lane]['slots'].acquire(blocking=False)
+            if not slot:
+              # set it aside rather than hold up the packages of the other lane
+              with records_lock:
+                deferred[lane].append(record)
+              continue
+          if not slot:
+            slot = lanes[lane]['slots'].acquire()
+          if stream:
+            path = None
+          else:
+            start = time.perf_counter()
+            path = fetch_oa_package(session, record['File'], base_url)
+            n_bytes = os.path.getsize(path)
+            track_download_disk(n_bytes)
+            record = dict(record, download_seconds=time.perf_counter() - start, bytes=n_bytes)
+        except Exception as e:
+          if slot: lanes[lane]['slots'].release()
+          results.put((record, e, None))
+          continue
+        fetched[lane].put((record['cost'], next(sequence), record, path))
+
+  def parse(lane):
+    while True:
+      _, _, record, path = fetched[lane].get()
+      if record is None: break
+      lanes[lane]['slots'].release()
+      record = dict(record, timeout=record.get('timeout', lanes[lane]['timeout']))
+      start = time.perf_counter()
+      try:
+        if path is None:
+          res = run(extract_oa_package_url, base_url + record['File'], timeout=record['timeout'])
+        else:
+          res = run(extract_oa_package_file, path, timeout=record['timeout'])
+      except Exception as e:
+        record = dict(record, seconds=time.perf_counter() - start)
+        if isinstance(e, TimeoutError):
+          cost_model.update_timeout(record['timeout'], record['package_bytes'])
+        results.put((record, e, None))
+      else:
+        _, stats = res
+        record = dict(record, seconds=time.perf_counter() - start, bytes=stats['bytes_compressed'])
+        cost_model.update(record['seconds'], stats)
+        results.put((record, None, res))
+      finally:
+        if path is not None:
+          track_download_disk(-os.path.getsize(path))
+          os.unlink(path)
+
+  def supervise():
+    downloaders = [threading.Thread(target=download, daemon=True) for _ in range(download_workers)]
+    parsers = [
+      threading.Thread(target=parse, args=(lane,), daemon=True)
+      for lane, options in lanes.items()
+      for _ in range(options['workers'])
+    ]
+    for thread in downloaders + parsers: thread.start()
+    for thread in downloaders: thread.join()
+    for lane, options in lanes.items():
+      for _ in range(options['workers']):
+        fetched[lane].put((float('inf'), next(sequence), None, None))
+    for thread in parsers: thread.join()
+    results.put(None)
+
+  threading.Thread(target=supervise, daemon=True).start()
+  while True:
+    result = results.get()
+    if result is None: break
+    yield result
+
+def print_run_summary(run_stats):
+  ''' Report the totals of the package stats for this run
+  '''
+  pdf_pages = run_stats['pdf_pages'] + run_stats['pdf_pages_skipped']
+  if pdf_pages:
+    print(
+      f"pdf pages: {run_stats['pdf_pages']} processed, {run_stats['pdf_pages_skipped']} skipped "
+      f"({run_stats['pdf_pages_skipped'] / pdf_pages:.1%}) in {run_stats['pdf_documents']} documents",
+      file=sys.stderr,
+    )
+  if run_stats['prefiltered']:
+    print(
+      f"pre-filter: {run_stats['downloads_avoided']} of {run_stats['prefiltered']} downloads avoided "
+      f"({run_stats['downloads_avoided'] / run_stats['prefiltered']:.1%})",
+      file=sys.stderr,
+    )
+  if run_stats['big_lane']:
+    print(f"packages extracted: {run_stats['small_lane']} small, {run_stats['big_lane']} big", file=sys.stderr)
+  if run_stats['cache_hits'] or run_stats['cache_misses']:
+    cache_lookups = run_stats['cache_hits'] + run_stats['cache_misses']
+    print(
+      f"supplement cache: {run_stats['cache_hits']} hits, {run_stats['cache_misses']} misses "
+      f"({run_stats['cache_hits'] / cache_lookups:.1%} hit rate)",
+      file=sys.stderr,
+    )
+  if run_stats['member_timeouts']:
+    print(f"supplementary files timed out: {run_stats['member_timeouts']}", file=sys.stderr)
+  if run_stats['timeout'] or run_stats['error']:
+    print(f"packages failed: {run_stats['timeout']} timed out, {run_stats['error']} errors", file=sys.stderr)
+  MiB = 1024**2
+  print(
+    f"i/o: {run_stats['bytes_compressed'] / MiB:.1f} MiB downloaded, "
+    f"{(run_stats['download_bytes_written'] + run_stats['temp_bytes_written']) / MiB:.1f} MiB written to temporary files; "
+    f"peak temporary disk usage: {run_stats['download_disk_peak'] / MiB:.1f} MiB of downloaded packages, "
+    f"{run_stats['temp_disk_peak'] / MiB:.1f} MiB by a single package",
+    file=sys.stderr,
+  )
+
+def main(
+  data_dir = Path(), oa_file_list = None, progress = 'done.txt', progress_output = 'done.new.txt', output = 'output.gmt', stats_output = 'stats.jsonl',
+  ledger = 'ledger.sqlite', file_list = 'oa_file_list.sqlite', file_list_url = oa_file_list_url, processes = None, persistent = True, max_tasks_per_worker = 100, max_worker_rss = 3*1024**3,
+  download_workers = 4, queue_size = None, base_url = oa_package_base_url, tabula_heap = '2g',
+  pdf_min_page_genes = pdf_min_page_genes, timeout = 60*5, max_attempts = 2, retry_timeout_factor = 4,
+  big_cost = 60, big_processes = None, big_timeout = None, member_timeout = member_timeout,
+  cache_path = Path('supplements.sqlite'), cache_size = 4*1024**3, stream = False,
+  prefilter = True, efetch_url = efetch_url, shard = None, report_output = 'report.json', report_interval = 60,
+):
+  '''
+  Work through the oa_file_list, synced incrementally into `file_list` (see: helper.oa_file_list)
+    -- you can instead filter a complete one (see: fetch_oa_file_list) and provide it to this function
+  Track progress by recording the outcome of each oa_package in the ledger (see: helper.ledger),
+    a legacy done.txt is imported into a new ledger, processed packages are also appended to done.new.txt
+  Packages which timed out get up to `max_attempts` attempts, each with `retry_timeout_factor` times
+    the previous budget, after all new packages
+  Packages estimated to take more than `big_cost` seconds are extracted by `big_processes` of the
+    workers with `big_timeout`, see: pipeline
+  Supplementary files taking longer than `member_timeout` are skipped, if a package times out
+    the gene sets it had already produced are kept
+  The gene sets of each supplementary file are cached by content in `cache_path`, up to `cache_size`
+    bytes (0 to disable it), see: helper.cache
   Write all results to output.gmt
+  Write per-package statistics (i.e. bytes decompressed) to stats.jsonl
+  Packages are downloaded by `download_workers` threads and extracted by `processes`
+    workers (see: pipeline), with persistent=True those are pre-warmed WorkerPool processes,
+    otherwise each package gets its own freshly spawned process
+  With stream=True the workers extract packages while downloading them instead, without a temporary copy
+  With prefilter=True packages whose article can't yield gene sets aren't downloaded (see: prefilter_oa_packages)
+  With shard=(i, n) only the i-th of n partitions of oa_file_list is processed (see: shard_of), its
+    progress & output files go into a shard-i-of-n sub-directory, to be combined with `helper merge-shards`
+  Write timings to report.json every `report_interval` seconds & at the end (see: helper.report), by
+    stage (download, the stages of extraction (see: _stage) & writing the output), by the extension
+    & outcome of supplementary files and by the outcome of packages
   '''
   data_dir.mkdir(parents=True, exist_ok=True)
   done_file = data_dir / progress
-  new_done_file = data_dir / progress_output
-  output_file = data_dir / output
+  if shard is None:
+    output_dir = data_dir
+  else:
+    shard_index, shard_count = shard
+    output_dir = data_dir / f"shard-{shard_index}-of-{shard_count}"
+    output_dir.mkdir(exist_ok=True)
+  new_done_file = output_dir / progress_output
+  output_file = output_dir / output
+  stats_file = output_dir / stats_output
+  report = TimingReport(output_dir / report_output, interval=report_interval)
 
   # prepare gene symbol lookup, since this preparation is somewhat slow
   #  doing this before hand speeds up the sub-tasks (which run in new processes) substantially
   gene_lookup_file = Path('lookup.json')
   if not gene_lookup_file.exists():
-    import json
     from maayanlab_bioinformatics.harmonization.ncbi_genes import ncbi_genes_fetch
     ncbi_genes = ncbi_genes_fetch(organism='Mammalia/Homo_sapiens')
     synonyms, symbols = zip(*{
@@ -436,56 +1668,242 @@ def main(data_dir = Path(), oa_file_list = None, progress = 'done.txt', progress
       (ncbi_lookup.index == ncbi_lookup) | (~ncbi_lookup.index.isin(ambiguous))
     )]
     lookup_dict = ncbi_lookup_disambiguated.to_dict()
-    with gene_lookup_file.open('w') as fw:
+    tmp = gene_lookup_file.with_name(f"{gene_lookup_file.name}.{os.getpid()}.tmp")
+    with tmp.open('w') as fw:
       json.dump(lookup_dict, fw)
+    os.replace(tmp, gene_lookup_file)
+  # build the memory mapped version of the lookup once, the workers share it
+  open_lookup(gene_lookup_file)
 
-  # find out what we've already processed
-  if done_file.exists():
-    with done_file.open('r') as fr:
-      done = set(filter(None, map(str.strip, fr)))
-  else:
-    done = set()
-
-  # find out what there remains to process
-  if oa_file_list is None:
-    oa_file_list = fetch_oa_file_list(data_dir)
-
-  oa_file_list_size = oa_file_list.shape[0]
-  oa_file_list = oa_file_list[~oa_file_list['File'].isin(list(done))]
-
-  # fetch and extract gmts from oa_packages using a process pool
-  #  append gmt term, gene sets as they are ready into one gmt file
-  with new_done_file.open('a') as done_file_fh:
-    with output_file.open('a') as output_fh:
-      with ThreadPool() as pool:
-        for record, err, res in tqdm.tqdm(
-          pool.imap_unordered(
-            task,
-            (
-              { 'File': row['File'] }
-              for _, row in oa_file_list.iterrows()
-            )
+  with contextlib.ExitStack() as stack:
+    main_ledger_file = data_dir / ledger
+    ledger = stack.enter_context(Ledger(output_dir / ledger))
+    if not len(ledger):
+      if shard is not None and main_ledger_file.exists():
+        ledger.import_ledger(main_ledger_file, keep=lambda file: shard_of(file, shard_count) == shard_index)
+      else:
+        ledger.import_done(done_file)
+
+    # find out what there remains to process
+    keep = None if shard is None else (lambda file: shard_of(file, shard_count) == shard_index)
+    if oa_file_list is None:
+      with FileList(data_dir / file_list) as oa_files:
+        new, changed = oa_files.sync(file_list_url)
+        print(f"oa_file_list: {new} new, {changed} changed packages")
+        oa_file_list_size = oa_files.count(keep)
+      pending_accessions = dict(ledger.pending_oa_files(data_dir / file_list, keep))
+    else:
+      if keep is not None:
+        oa_file_list = oa_file_list[oa_file_list['File'].map(keep)]
+      oa_file_list_size = oa_file_list.shape[0]
+      # accessions are only needed to pre-filter packages
+      accessions = dict(zip(oa_file_list['File'], oa_file_list['Accession ID'])) if 'Accession ID' in oa_file_list else {}
+      pending_accessions = {file: accessions.get(file) for file in ledger.pending(oa_file_list['File'])}
+    pending = list(pending_accessions)
+    retries = ledger.retries(max_attempts, retry_timeout_factor)
+    ledger.start_run()
+    costs = ledger.costs()
+    if costs.pop('version', None) != CostModel.version: costs = {}
+    cost_model = CostModel(overhead=costs.pop('overhead', None), rates=costs)
+    run_stats = collections.Counter()
+    io_stats = collections.Counter()
+
+    # only download the packages which could yield gene sets
+    skipped = []
+    if prefilter and pending:
+      start = time.perf_counter()
+      pending, skipped = prefilter_oa_packages(
+        ledger, list(pending_accessions.items()), efetch_url,
+        shards=1 if shard is None else shard_count,
+      )
+      report.observe('stage', 'prefilter', time.perf_counter() - start)
+      ledger.skip(skipped)
+      run_stats['prefiltered'] = len(pending) + len(skipped)
+      run_stats['downloads_avoided'] = len(skipped)
+    # the supplementary files their articles list, what their cost is estimated from
+    listings = ledger.listings(pending_accessions[file] for file in pending if pending_accessions[file] is not None)
+
+    # fetch and extract gmts from oa_packages using a process pool
+    #  append gmt term, gene sets as they are ready into one gmt file
+    worker_initargs = ([f"-Xmx{tabula_heap}"], pdf_min_page_genes, member_timeout, cache_path, cache_size)
+    # warming up workers (JVM, lookup, cache) is only worth it with something to do
+    if persistent and (pending or retries):
+      run = stack.enter_context(WorkerPool(
+        processes,
+        initializer=_warm_worker,
+        initargs=worker_initargs,
+        max_tasks=max_tasks_per_worker,
+        max_rss=max_worker_rss,
+      )).run
+    else:
+      # each package's process gets the same settings, without the benefit of staying warm
+      run = functools.partial(run_with_timeout, initializer=_warm_worker, initargs=worker_initargs)
+    done_file_fh = stack.enter_context(new_done_file.open('a'))
+    for file in skipped:
+      print(file, file=done_file_fh)
+    output_fh = stack.enter_context(output_file.open('a'))
+    stats_fh = stack.enter_context(stats_file.open('a'))
+    for record, err, res in tqdm.tqdm(
+      pipeline(
+        itertools.chain(
+          (
+            { 'File': file, 'extensions': listings[pending_accessions[file]][0] }
+            if pending_accessions[file] in listings else { 'File': file }
+            for file in pending
           ),
-          initial=oa_file_list_size - oa_file_list.shape[0],
-          total=oa_file_list_size
-        ):
-          if err is None:
-            for term, description, gene_set in res:
-              print(
-                term,
-                description,
-                *gene_set,
-                sep='\t',
-                file=output_fh,
-              )
-          else:
-            print(err, file=sys.stderr)
-          print(record['File'], file=done_file_fh)
-          output_fh.flush()
-          done_file_fh.flush()
+          # timed out packages go last, with a larger budget
+          ({ 'File': file, 'timeout': retry_timeout } for file, retry_timeout in retries),
+        ),
+        run=run,
+        download_workers=download_workers,
+        parse_workers=processes,
+        queue_size=queue_size,
+        base_url=base_url,
+        timeout=timeout,
+        cost_model=cost_model,
+        big_cost=big_cost,
+        big_workers=big_processes,
+        big_timeout=big_timeout,
+        stream=stream,
+        io_stats=io_stats,
+      ),
+      initial=oa_file_list_size - len(pending),
+      total=oa_file_list_size + len(retries),
+    ):
+      if 'lane' in record:
+        run_stats[f"{record['lane']}_lane"] += 1
+      attempt = dict(
+        timeout=record.get('timeout'),
+        seconds=record.get('seconds'),
+        download_seconds=record.get('download_seconds'),
+        bytes=record.get('bytes'),
+      )
+      if err is None:
+        gene_sets, stats = res
+        members = stats['members']
+      else:
+        # keep whatever was extracted before a time out
+        partial = getattr(err, 'partial', [])
+        gene_sets = [gene_set for kind, gene_set in partial if kind == 'gene_set']
+        members = [member for kind, member in partial if kind == 'member']
+      # an earlier attempt which timed out already wrote some of them
+      emitted = ledger.emitted_terms(record['File'])
+      start = time.perf_counter()
+      for term, description, gene_set in gene_sets:
+        if term in emitted: continue
+        print(
+          term,
+          description,
+          *gene_set,
+          sep='\t',
+          file=output_fh,
+        )
+      output_fh.flush()
+      report.observe('stage', 'write_output', time.perf_counter() - start)
+      if record.get('download_seconds') is not None:
+        report.observe('stage', 'download', record['download_seconds'])
+      for member in members:
+        report.observe('extension', PurePosixPath(member['member']).suffix.lower(), member['seconds'])
+        report.observe('member_outcome', member['status'], member['seconds'])
+      if members:
+        ledger.record_members(record['File'], members)
+      if err is None:
+        print(json.dumps(dict(File=record['File'], **stats)), file=stats_fh)
+        for key, value in stats.items():
+          if not isinstance(value, (int, float)): continue
+          if key.endswith('_peak'): run_stats[key] = max(run_stats[key], value)
+          else: run_stats[key] += value
+        for stage, seconds in stats['stages'].items():
+          report.observe('stage', stage, seconds)
+        ledger.record(record['File'], 'ok', gene_sets=len(gene_sets), **attempt)
+        status = 'ok'
+      else:
+        print(''.join(traceback.format_exception(err)), file=sys.stderr)
+        # only extraction (which has seconds) time outs are worth retrying
+        status = 'timeout' if isinstance(err, TimeoutError) and 'seconds' in record else 'error'
+        ledger.record(record['File'], status, error=type(err).__name__, gene_sets=len(gene_sets) if gene_sets else None, **attempt)
+        if status == 'timeout' and gene_sets:
+          ledger.record_terms(record['File'], (term for term, _, _ in gene_sets))
+        run_stats[status] += 1
+      if record.get('seconds') is not None:
+        report.observe('package_outcome', status, record['seconds'])
+      print(record['File'], file=done_file_fh)
+      stats_fh.flush()
+      done_file_fh.flush()
+      report.maybe_write(totals=run_stats)
+    run_stats.update(download_bytes_written=io_stats['download_bytes_written'], download_disk_peak=io_stats['download_disk_peak'])
+    ledger.save_costs(dict(cost_model.rates, overhead=cost_model.overhead, version=CostModel.version))
+    ledger.finish_run()
+    report.write(finished=True, totals=run_stats)
+
+  print_run_summary(run_stats)
+  print(f"timings: {report.path}")
+
+def _parse_shard(ctx, param, value):
+  if value is None: return None
+  try:
+    shard_index, shard_count = map(int, value.split('/'))
+  except ValueError:
+    raise click.BadParameter('expected i/N')
+  if not 0 <= shard_index < shard_count:
+    raise click.BadParameter('expected 0 <= i < N')
+  return shard_index, shard_count
+
+@click.command()
+@click.option('--data-dir', envvar='PTH', default='data', type=click.Path(file_okay=False, path_type=Path), help='Directory for progress & output files')
+@click.option('-j', '--processes', type=int, default=None, help='Number of packages to extract concurrently (default: cpu count)')
+@click.option('--persistent/--no-persistent', default=True, help='Extract on long-lived pre-warmed workers instead of a new process per package')
+@click.option('--max-tasks-per-worker', type=int, default=100, help='Recycle a persistent worker after this many packages')
+@click.option('--max-worker-rss', type=int, default=3072, help='Recycle a persistent worker once it uses more than this many MiB (keep it above --tabula-heap)')
+@click.option('--download-workers', type=int, default=4, help='Number of packages to download concurrently')
+@click.option('--queue-size', type=int, default=None, help='Maximum number of downloaded packages waiting to be extracted (default: 2x processes)')
+@click.option('--base-url', envvar='OA_BASE_URL', default=oa_package_base_url, help='Where to download oa_packages from')
+@click.option('--tabula-heap', default='2g', help='Maximum heap size of the JVM used for pdf table extraction in each worker')
+@click.option('--pdf-min-page-genes', type=int, default=pdf_min_page_genes, help='Only extract tables from pdf pages with at least this many gene-like tokens (0 for all pages)')
+@click.option('--timeout', type=int, default=60*5, help='Seconds to extract a single package in')
+@click.option('--max-attempts', type=int, default=2, help='Number of times to attempt packages which time out')
+@click.option('--retry-timeout-factor', type=float, default=4, help='Increase the timeout of each retry by this factor')
+@click.option('--big-cost', type=float, default=60, help='Packages estimated to take longer than this many seconds are extracted in the big lane')
+@click.option('--big-processes', type=int, default=None, help='Number of processes reserved for big packages (default: a quarter)')
+@click.option('--big-timeout', type=int, default=None, help='Seconds to extract a big package in (default: 3x --timeout)')
+@click.option('--member-timeout', type=int, default=member_timeout, help='Seconds to extract a single supplementary file in, before skipping it (0 for no limit)')
+@click.option('--cache', 'cache_path', default='supplements.sqlite', type=click.Path(dir_okay=False, path_type=Path), help='Cache of the gene sets extracted from supplementary files, shared between runs')
+@click.option('--cache-size', type=int, default=4096, help='Maximum size of the cache in MiB (0 to disable it)')
+@click.option('--stream/--no-stream', default=False, help='Extract packages while downloading them, instead of from a temporary copy')
+@click.option('--file-list-url', envvar='OA_FILE_LIST_URL', default=oa_file_list_url, help='Where to sync the oa_file_list (oa_file_list.sqlite) from')
+@click.option('--prefilter/--no-prefilter', default=True, help='Skip packages whose article shows they can\'t yield gene sets, without downloading them')
+@click.option('--efetch-url', envvar='EFETCH_URL', default=efetch_url, help='E-utilities efetch endpoint to fetch article xml from')
+@click.option('--report-interval', type=int, default=60, help='Seconds between updates of the timings report (report.json)')
+@click.option('--shard', callback=_parse_shard, default=None, help='Only process the i-th of N partitions of the packages (i/N, 0-based), combine the shards with `helper merge-shards`')
+def cli(data_dir, processes, persistent, max_tasks_per_worker, max_worker_rss, download_workers, queue_size, base_url, tabula_heap, pdf_min_page_genes, timeout, max_attempts, retry_timeout_factor, big_cost, big_processes, big_timeout, member_timeout, cache_path, cache_size, stream, file_list_url, prefilter, efetch_url, shard, report_interval):
+  main(
+    data_dir,
+    processes=processes,
+    persistent=persistent,
+    max_tasks_per_worker=max_tasks_per_worker,
+    max_worker_rss=max_worker_rss*1024**2,
+    download_workers=download_workers,
+    queue_size=queue_size,
+    base_url=base_url,
+    tabula_heap=tabula_heap,
+    pdf_min_page_genes=pdf_min_page_genes,
+    timeout=timeout,
+    max_attempts=max_attempts,
+    retry_timeout_factor=retry_timeout_factor,
+    big_cost=big_cost,
+    big_processes=big_processes,
+    big_timeout=big_timeout,
+    member_timeout=member_timeout,
+    cache_path=cache_path,
+    cache_size=cache_size*1024**2,
+    stream=stream,
+    file_list_url=file_list_url,
+    prefilter=prefilter,
+    efetch_url=efetch_url,
+    shard=shard,
+    report_interval=report_interval,
+  )
 
 if __name__ == '__main__':
-  import os
   from dotenv import load_dotenv; load_dotenv()
-  data_dir = Path(os.environ.get('PTH', 'data'))
-  main(data_dir)
+  cli()
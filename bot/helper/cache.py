@@ -0,0 +1,100 @@
+''' A content-addressed cache of the gene sets extracted from supplementary files.
+
+The same supplementary file shows up in several versions of a package and again when a
+run is repeated, entries are keyed by a hash of the file's bytes (see: content_key) so
+it only needs to be parsed once. The cache is a sqlite database shared by all the workers,
+it's bounded to max_size bytes by evicting the least recently used entries.
+'''
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import functools
+from pathlib import Path
+
+_schema = '''
+create table if not exists entry (
+  key text primary key,
+  value blob not null,
+  size integer not null,
+  used real not null
+);
+create index if not exists entry_used_idx on entry (used);
+create table if not exists total (
+  id integer primary key check (id = 0),
+  size integer not null
+);
+insert into total (id, size) values (0, 0) on conflict (id) do nothing;
+create trigger if not exists entry_insert after insert on entry begin
+  update total set size = size + new.size where id = 0;
+end;
+create trigger if not exists entry_delete after delete on entry begin
+  update total set size = size - old.size where id = 0;
+end;
+'''
+
+def content_key(f, *salt, chunk_size=1024*1024):
+  ''' The cache key of the contents of a (seekable) file handle, salted with anything else
+  the result depends on
+  '''
+  h = hashlib.sha256()
+  for s in salt:
+    h.update(str(s).encode())
+    h.update(b'\0')
+  f.seek(0)
+  while True:
+    chunk = f.read(chunk_size)
+    if not chunk: break
+    h.update(chunk)
+  f.seek(0)
+  return h.hexdigest()
+
+class SupplementCache:
+  ''' A size-bounded LRU cache of json serializable values, stored in sqlite
+  '''
+  def __init__(self, path: Path | str, max_size: int = 1024**3):
+    self.max_size = max_size
+    self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    self.conn.execute('pragma journal_mode = wal')
+    self.conn.execute('pragma synchronous = normal')
+    self.conn.executescript(_schema)
+
+  def get(self, key):
+    row = self.conn.execute('select value from entry where key = ?', (key,)).fetchone()
+    if row is None: return None
+    self.conn.execute('update entry set used = ? where key = ?', (time.time(), key))
+    return json.loads(zlib.decompress(row[0]))
+
+  def put(self, key, value):
+    ''' Store a value, values which aren't json serializable (i.e. cells with dates) are skipped
+    '''
+    try:
+      value = zlib.compress(json.dumps(value).encode())
+    except (TypeError, ValueError):
+      return
+    if len(value) > self.max_size: return
+    self.conn.execute('begin immediate')
+    try:
+      self.conn.execute(
+        'insert into entry (key, value, size, used) values (?, ?, ?, ?) on conflict (key) do nothing',
+        (key, value, len(value), time.time())
+      )
+      size, = self.conn.execute('select size from total where id = 0').fetchone()
+      while size > self.max_size:
+        # evict the least recently used entry
+        self.conn.execute('delete from entry where key = (select key from entry order by used limit 1)')
+        size, = self.conn.execute('select size from total where id = 0').fetchone()
+      self.conn.execute('commit')
+    except:
+      self.conn.execute('rollback')
+      raise
+
+  def close(self):
+    self.conn.close()
+
+@functools.cache
+def open_cache(path: Path | str, max_size: int = 1024**3):
+  ''' The (per-process) SupplementCache at path
+  '''
+  return SupplementCache(path, max_size)
@@ -1,8 +1,10 @@
+import io
+import os
 import click
+import multiprocessing as mp
 from pathlib import Path
 from helper.cli import cli
-
-lookup = None
+from helper.lookup import gene_lookup_many, open_lookup
 
 def unique(L):
   S = set()
@@ -13,40 +15,77 @@ def unique(L):
     L_.append(el)
   return L_
 
+def gmt_chunks(path: Path, chunk_size: int):
+  ''' Byte ranges of the file of about chunk_size bytes, each ending on a line boundary
+  '''
+  size = path.stat().st_size
+  with path.open('rb') as fr:
+    start = 0
+    while start < size:
+      fr.seek(min(start + chunk_size, size))
+      fr.readline()
+      end = min(fr.tell(), size)
+      yield start, end
+      start = end
+
+def _clean_chunk(args):
+  ''' The (term, line) of the gene sets in a byte range of the gmt which pass the filters,
+  terms are de-duplicated by the caller since duplicates can span chunks
+  '''
+  path, start, end = args
+  with open(path, 'rb') as fr:
+    fr.seek(start)
+    chunk = fr.read(end - start)
+  # decoded just like input.open('r') would
+  genesets = []
+  for line in filter(None, map(str.strip, io.TextIOWrapper(io.BytesIO(chunk)))):
+    term, _, *geneset = line.split('\t')
+    genesets.append((term, geneset))
+  # map the genes of the whole chunk in one batch
+  mapped = gene_lookup_many([gene for _, geneset in genesets for gene in geneset]).tolist()
+  cleaned = []
+  offset = 0
+  for term, geneset in genesets:
+    geneset_mapped = unique([gene_mapped for gene_mapped in mapped[offset:offset + len(geneset)] if gene_mapped])
+    offset += len(geneset)
+    if (
+      len(geneset_mapped) >= 5
+      and len(geneset_mapped) < 2500
+      and len(term) < 200
+    ):
+      cleaned.append((term, '\t'.join([term, '', *geneset_mapped]) + '\n'))
+  return cleaned
+
+class _InProcess:
+  ''' Stand-in for a Pool when there's a single process
+  '''
+  def imap(self, func, iterable):
+    return map(func, iterable)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
 @cli.command()
 @click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='GMT file to clean')
 @click.option('-o', '--output', type=click.Path(path_type=Path), help='Output location')
-def clean(input, output):
-  import re
-  def gene_lookup(value):
-    ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
-    '''
-    if type(value) != str: return None
-    if re.search(r'\s', value): return None
-    if re.match(r'\d+(\.\d+)?', value): return None
-    global lookup
-    if lookup is None:
-      import json
-      with open('lookup.json', 'r') as fr:
-        lookup = json.load(fr).get
-    return lookup(value)
-
+@click.option('-j', '--processes', type=int, default=None, help='Number of processes to clean chunks of the input with (default: cpu count)')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=16, help='Size of the chunks of the input in MiB')
+def clean(input, output, processes, chunk_size):
+  ''' Map the genes of each gene set to symbols, keeping the first gene set of each term
+  with an acceptable size. Chunks of the input are cleaned in parallel & written in order.
+  '''
+  processes = processes or os.cpu_count()
+  chunks = ((str(input), start, end) for start, end in gmt_chunks(input, chunk_size*1024**2))
+  # build lookup.bin here once, rather than in every worker at the same time
+  open_lookup()
   terms = set()
-  with input.open('r') as fr:
-    with output.open('w') as fw:
-      for line in filter(None, map(str.strip, fr)):
-        term, _, *geneset = line.split('\t')
-        geneset_mapped = unique([gene_mapped for gene in geneset for gene_mapped in (gene_lookup(gene),) if gene_mapped])
-        if (
-          len(geneset_mapped) >= 5
-          and len(geneset_mapped) < 2500
-          and len(term) < 200
-          and term not in terms
-        ):
+  with output.open('w') as fw:
+    with mp.get_context('spawn').Pool(processes) if processes > 1 else _InProcess() as pool:
+      for cleaned in pool.imap(_clean_chunk, chunks):
+        for term, line in cleaned:
+          if term in terms: continue
           terms.add(term)
-          print(
-            term, '',
-            *geneset_mapped,
-            sep='\t',
-            file=fw,
-          )
+          fw.write(line)
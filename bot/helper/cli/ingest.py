@@ -1,61 +1,105 @@
+import io
+import os
+import re
+import json
+import time
+import uuid
 import click
+import contextlib
 import df2pg
 from pathlib import Path
 from tqdm import tqdm
 from helper.cli import cli
 
-def import_gene_set_library(
-  plpy,
+def parse_gmt_line(line: str, prefix='', postfix=''):
+  ''' The (term, description, genes) of a line of a gmt, None if it doesn't have any genes
+  '''
+  line_split = line.strip().split('\t')
+  if len(line_split) < 3: return None
+  term, description, *raw_genes = line_split
+  genes = [
+    cleaned_gene
+    for raw_gene in map(str.strip, raw_genes)
+    if raw_gene
+    for cleaned_gene in (re.split(r'[;,:\s]', raw_gene)[0],)
+    if cleaned_gene
+  ]
+  return prefix+term+postfix, description, genes
+
+def gene_set_hash(genes):
+  return uuid.uuid5(uuid.UUID('00000000-0000-0000-0000-000000000000'), '\t'.join(sorted(set(genes))))
+
+def read_gmt_batches(
   library: Path | str,
   prefix='',
   postfix='',
+  batch_size=10000,
 ):
-  import re
-  import json
-  import uuid
-
-  # fetch the gene_set, gather the background genes
-  new_gene_sets = []
-  background_genes = set()
-  n_geneset_genes = 0
+  ''' Parse the gene sets of a gmt, in lists of at most batch_size gene sets
+  '''
+  batch = []
   with Path(library).open('r') as fr:
-    for line in tqdm(fr, desc='Loading gmt...'):
-      line_split = line.strip().split('\t')
-      if len(line_split) < 3: continue
-      term, description, *raw_genes = line_split
-      genes = [
-        cleaned_gene
-        for raw_gene in map(str.strip, raw_genes)
-        if raw_gene
-        for cleaned_gene in (re.split(r'[;,:\s]', raw_gene)[0],)
-        if cleaned_gene
-      ]
-      new_gene_sets.append(dict(
-        term=prefix+term+postfix,
+    for line in fr:
+      parsed = parse_gmt_line(line, prefix=prefix, postfix=postfix)
+      if parsed is None: continue
+      term, description, genes = parsed
+      batch.append(dict(
+        term=term,
         description=description,
         genes=genes,
-        hash=uuid.uuid5(uuid.UUID('00000000-0000-0000-0000-000000000000'), '\t'.join(sorted(set(genes)))),
+        hash=gene_set_hash(genes),
       ))
-      background_genes.update(genes)
-      n_geneset_genes += len(genes)
-
-  # get a mapping from background_genes to background_gene_ids
-  gene_map, = plpy.cursor(
-    plpy.prepare(
-      '''
-        select coalesce(jsonb_object_agg(g.gene, g.gene_id), '{}') as gene_map
-        from app_public_v2.gene_map($1) as g
-      ''',
-      ['varchar[]']
-    ),
-    [list(background_genes)]
-  )
-  gene_map = json.loads(gene_map['gene_map'])
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+  if batch:
+    yield batch
+
+def gene_table_version(plpy):
+  ''' A stamp of the contents of the gene table which gene_map depends on, the table doesn't
+  have timestamps so it's the row count & a digest of the genes' ids, symbols & synonyms
+  '''
+  version, = plpy.cursor('''
+    select count(*) || ':' || coalesce(md5(string_agg(
+      g.id::text || ':' || g.symbol || ':' || coalesce(g.synonyms::text, ''), ',' order by g.id
+    )), '') as version
+    from app_public_v2.gene g
+  ''', tuple())
+  return version['version']
+
+def map_genes(plpy, genes: set, gene_map: dict, gene_map_cache=None, batch_size=5000):
+  ''' Add the gene_ids of genes which aren't in gene_map yet to it, inserting the genes the
+  database doesn't know about. With a GeneMapCache (see: helper.gene_map_cache), only the
+  genes missing from it are looked up in the database, in batches of batch_size.
+  '''
+  unmapped_genes = genes - gene_map.keys()
+  if gene_map_cache is not None and unmapped_genes:
+    cached_gene_map = gene_map_cache.get_many(unmapped_genes)
+    gene_map.update(cached_gene_map)
+    unmapped_genes -= cached_gene_map.keys()
+
+  # get a mapping from genes to gene_ids
+  unmapped_genes = sorted(unmapped_genes)
+  for i in range(0, len(unmapped_genes), batch_size):
+    batch_gene_map, = plpy.cursor(
+      plpy.prepare(
+        '''
+          select coalesce(jsonb_object_agg(g.gene, g.gene_id), '{}') as gene_map
+          from app_public_v2.gene_map($1) as g
+        ''',
+        ['varchar[]']
+      ),
+      [unmapped_genes[i:i+batch_size]]
+    )
+    batch_gene_map = json.loads(batch_gene_map['gene_map'])
+    gene_map.update(batch_gene_map)
+    if gene_map_cache is not None:
+      gene_map_cache.put_many(batch_gene_map)
 
   # upsert any new genes not in the mapping & add them to the mapping
   new_genes = {
     id: dict(id=id, symbol=gene)
-    for gene in tqdm(background_genes - gene_map.keys(), desc='Preparing new genes...')
+    for gene in genes - gene_map.keys()
     for id in (str(uuid.uuid4()),)
   }
   if new_genes:
@@ -63,23 +107,63 @@ def import_gene_set_library(
       con=plpy.conn,
       table='app_public_v2.gene',
       columns=('id', 'symbol',),
-      records=tqdm(new_genes.values(), desc='Inserting new genes...')
+      records=new_genes.values(),
     )
-    gene_map.update({
+    new_gene_map = {
       new_gene['symbol']: new_gene['id']
       for new_gene in new_genes.values()
-    })
+    }
+    gene_map.update(new_gene_map)
+    if gene_map_cache is not None:
+      gene_map_cache.put_many(new_gene_map)
+  return gene_map
 
-  existing = {
-    (row['term'], row['description'], row['hash'])
-    for row in plpy.cursor('select term, description, hash from app_public_v2.gene_set', tuple())
-  }
+def _stage_gene_map_cache(plpy, gene_map_cache):
+  ''' Stage the cache with the version of the gene table it's valid for after this ingest
+  '''
+  gene_map_cache.stage(gene_table_version(plpy))
+  click.echo(f"gene map cache: {gene_map_cache.hits} hits, {gene_map_cache.misses} misses ({gene_map_cache.hit_rate():.1%} hit rate)")
+
+def import_gene_set_library(
+  plpy,
+  library: Path | str,
+  prefix='',
+  postfix='',
+  batch_size=10000,
+  gene_map_cache=None,
+):
+  ''' Ingest the gene sets of a gmt which aren't in the database yet, returns the number of gene sets read.
+
+  The gmt is streamed in batches of batch_size gene sets, each batch's new genes & gene sets are
+  inserted before the next one is read so memory is bounded by the batch size (and the genes seen
+  so far) rather than by the size of the gmt. Gene sets are staged in a temporary table, the ones
+  which aren't in the database yet are found by an (indexed) anti-join in postgres rather than by
+  pulling all existing gene sets. Nothing is committed, the caller commits or rolls back (along
+  with the gene_map_cache, if any).
+  '''
+  if gene_map_cache is not None:
+    gene_map_cache.validate(gene_table_version(plpy))
+  plpy.execute('''
+    create temporary table gene_set_staging (
+      term varchar not null,
+      description varchar,
+      hash uuid not null,
+      gene_ids jsonb not null,
+      n_gene_ids integer not null
+    ) on commit drop
+  ''', [])
 
-  df2pg.copy_from_records(
-    con=plpy.conn,
-    table='app_public_v2.gene_set',
-    columns=('term', 'description', 'hash', 'gene_ids', 'n_gene_ids'),
-    records=tqdm((
+  # background gene -> gene_id, of the genes seen so far
+  gene_map = {}
+  n_gene_sets = 0
+  progress = tqdm(desc='Inserting new genesets...')
+  for new_gene_sets in read_gmt_batches(library, prefix=prefix, postfix=postfix, batch_size=batch_size):
+    map_genes(plpy, {gene for gene_set in new_gene_sets for gene in gene_set['genes']}, gene_map, gene_map_cache)
+    df2pg.copy_from_records(
+      con=plpy.conn,
+      table='gene_set_staging',
+      columns=('term', 'description', 'hash', 'gene_ids', 'n_gene_ids'),
+      records=(
         dict(
           term=gene_set['term'],
           description=gene_set['description'],
@@ -88,29 +172,209 @@ def import_gene_set_library(
           n_gene_ids=len(gene_set['genes']),
         )
         for gene_set in new_gene_sets
-        if (gene_set['term'], gene_set['description'], gene_set['hash']) not in existing
       ),
-      total=len(new_gene_sets) - len(existing),
-      desc='Inserting new genesets...'
-    ),
-    on=dict(
-      conflict=('term',),
-      update=False,
-    ), # TODO: do we want to update updated description/gene sets? why would it happen?
-  )
+    )
+    # TODO: do we want to update updated description/gene sets? why would it happen?
+    plpy.execute('''
+      insert into app_public_v2.gene_set (term, description, hash, gene_ids, n_gene_ids)
+      select staged.term, staged.description, staged.hash, staged.gene_ids, staged.n_gene_ids
+      from gene_set_staging staged
+      where not exists (
+        select 1
+        from app_public_v2.gene_set gs
+        where gs.term = staged.term
+          and gs.description = staged.description
+          and gs.hash = staged.hash
+      )
+      on conflict (term) do nothing
+    ''', [])
+    plpy.execute('truncate gene_set_staging', [])
+    n_gene_sets += len(new_gene_sets)
+    progress.update(len(new_gene_sets))
+  progress.close()
+  if gene_map_cache is not None:
+    _stage_gene_map_cache(plpy, gene_map_cache)
 
   plpy.execute('refresh materialized view concurrently app_public_v2.gene_set_pmc', [])
+  return n_gene_sets
 
-@cli.command()
-@click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='GMT file to ingest')
-@click.option('--prefix', type=str, default='', help='Prefix to add to terms')
-@click.option('--postfix', type=str, default='', help='Postfix to add to terms')
-def ingest(input, prefix, postfix):
-  from helper.plpy import plpy
+# the gene map & connection of a copy worker (see: _copy_chunk)
+_worker_gene_map = None
+_worker_conn = None
+
+def _init_copy_worker(gene_map):
+  global _worker_gene_map, _worker_conn
+  import psycopg2
+  _worker_gene_map = gene_map
+  _worker_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+
+def _copy_text(value: str):
+  ''' Escape a value for COPY's text format
+  '''
+  return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _copy_chunk(args):
+  ''' Serialize the gene sets in a byte range of the gmt & COPY them into the staging table over
+  this worker's connection, returns the number of gene sets
+  '''
+  library, staging, chunk, start, end, prefix, postfix = args
+  with open(library, 'rb') as fr:
+    fr.seek(start)
+    data = fr.read(end - start)
+  rows = io.StringIO()
+  n_gene_sets = 0
+  # decoded just like Path(library).open('r') would
+  for line_number, line in enumerate(io.TextIOWrapper(io.BytesIO(data))):
+    parsed = parse_gmt_line(line, prefix=prefix, postfix=postfix)
+    if parsed is None: continue
+    term, description, genes = parsed
+    gene_ids = json.dumps({_worker_gene_map[gene]: position for position, gene in enumerate(genes)})
+    rows.write('\t'.join([
+      str(chunk), str(line_number), _copy_text(term), _copy_text(description),
+      str(gene_set_hash(genes)), _copy_text(gene_ids), str(len(genes)),
+    ]) + '\n')
+    n_gene_sets += 1
+  rows.seek(0)
+  with _worker_conn.cursor() as cur:
+    cur.copy_expert(f"copy {staging} (chunk, line, term, description, hash, gene_ids, n_gene_ids) from stdin", rows)
+  _worker_conn.commit()
+  return n_gene_sets
+
+def _drop_staging_table(staging):
+  ''' Drop the staging table over a connection of its own, the import's may be left in a failed
+  state (or closed) by whatever went wrong, which this then mustn't hide
+  '''
+  import psycopg2
   try:
-    import_gene_set_library(plpy, input, prefix=prefix, postfix=postfix)
+    with contextlib.closing(psycopg2.connect(os.environ['DATABASE_URL'])) as conn:
+      with conn.cursor() as cur:
+        cur.execute(f"drop table if exists {staging}")
+      conn.commit()
+  except Exception as e:
+    click.echo(f"couldn't drop the staging table {staging}: {e}", err=True)
+
+def import_gene_set_library_parallel(
+  plpy,
+  library: Path | str,
+  prefix='',
+  postfix='',
+  processes=None,
+  chunk_size=16*1024**2,
+  commit=True,
+  gene_map_cache=None,
+):
+  ''' Like import_gene_set_library, for bulk backfills: byte ranges of the gmt are serialized by
+  `processes` workers which COPY them into an unlogged staging table over their own connections,
+  the gene sets are then inserted with a single set-based insert, in the order of the gmt.
+
+  The staging table has to be committed for the workers to see it, so unlike import_gene_set_library
+  this manages the transaction: the new genes & gene sets are committed together at the end (rolled
+  back instead with commit=False), as is the gene_map_cache, and the staging table is always dropped.
+  Returns the number of gene sets read.
+  '''
+  import multiprocessing as mp
+  from helper.cli.clean import gmt_chunks
+  staging = f"app_private_v2.gene_set_staging_{uuid.uuid4().hex}"
+  plpy.execute(f'''
+    create unlogged table {staging} (
+      chunk integer not null,
+      line integer not null,
+      term varchar not null,
+      description varchar,
+      hash uuid not null,
+      gene_ids jsonb not null,
+      n_gene_ids integer not null
+    )
+  ''', [])
+  plpy.conn.commit()
+  try:
+    if gene_map_cache is not None:
+      gene_map_cache.validate(gene_table_version(plpy))
+    # the workers need the gene_ids of all the genes up front
+    background_genes = set()
+    with Path(library).open('r') as fr:
+      for line in tqdm(fr, desc='Collecting genes...'):
+        parsed = parse_gmt_line(line)
+        if parsed is not None: background_genes.update(parsed[2])
+    gene_map = map_genes(plpy, background_genes, {}, gene_map_cache)
+    if gene_map_cache is not None:
+      _stage_gene_map_cache(plpy, gene_map_cache)
+
+    chunks = [
+      (str(library), staging, chunk, start, end, prefix, postfix)
+      for chunk, (start, end) in enumerate(gmt_chunks(Path(library), chunk_size))
+    ]
+    n_gene_sets = 0
+    with mp.get_context('spawn').Pool(processes or os.cpu_count(), initializer=_init_copy_worker, initargs=(gene_map,)) as pool:
+      for n in tqdm(pool.imap_unordered(_copy_chunk, chunks), total=len(chunks), desc='Staging genesets...'):
+        n_gene_sets += n
+
+    # TODO: do we want to update updated description/gene sets? why would it happen?
+    plpy.execute(f'''
+      insert into app_public_v2.gene_set (term, description, hash, gene_ids, n_gene_ids)
+      select staged.term, staged.description, staged.hash, staged.gene_ids, staged.n_gene_ids
+      from {staging} staged
+      where not exists (
+        select 1
+        from app_public_v2.gene_set gs
+        where gs.term = staged.term
+          and gs.description = staged.description
+          and gs.hash = staged.hash
+      )
+      order by staged.chunk, staged.line
+      on conflict (term) do nothing
+    ''', [])
+    plpy.execute('refresh materialized view concurrently app_public_v2.gene_set_pmc', [])
   except:
     plpy.conn.rollback()
+    if gene_map_cache is not None: gene_map_cache.rollback()
     raise
   else:
-    plpy.conn.commit()
+    if commit:
+      plpy.conn.commit()
+      if gene_map_cache is not None: gene_map_cache.commit()
+    else:
+      plpy.conn.rollback()
+      if gene_map_cache is not None: gene_map_cache.rollback()
+  finally:
+    _drop_staging_table(staging)
+  return n_gene_sets
+
+@cli.command()
+@click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='GMT file to ingest')
+@click.option('--prefix', type=str, default='', help='Prefix to add to terms')
+@click.option('--postfix', type=str, default='', help='Postfix to add to terms')
+@click.option('--batch-size', type=int, default=10000, help='Number of gene sets to read & insert at a time')
+@click.option('-j', '--processes', type=int, default=1, help='Stage gene sets with this many processes & connections, for bulk backfills (0 for cpu count)')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=16, help='Size of the chunks of the input each process stages at a time in MiB (with -j)')
+@click.option('--benchmark', is_flag=True, help='Roll back instead of committing & report the throughput')
+@click.option('--gene-map-cache', default='gene_map.sqlite', help='Local cache of gene symbol -> gene_id, shared between runs (empty to disable it)')
+def ingest(input, prefix, postfix, batch_size, processes, chunk_size, benchmark, gene_map_cache):
+  from helper.plpy import plpy
+  from helper.gene_map_cache import GeneMapCache
+  start = time.perf_counter()
+  with contextlib.ExitStack() as stack:
+    gene_map_cache = stack.enter_context(GeneMapCache(gene_map_cache)) if gene_map_cache else None
+    if processes == 1:
+      try:
+        n_gene_sets = import_gene_set_library(plpy, input, prefix=prefix, postfix=postfix, batch_size=batch_size, gene_map_cache=gene_map_cache)
+      except:
+        plpy.conn.rollback()
+        if gene_map_cache is not None: gene_map_cache.rollback()
+        raise
+      else:
+        if benchmark:
+          plpy.conn.rollback()
+          if gene_map_cache is not None: gene_map_cache.rollback()
+        else:
+          plpy.conn.commit()
+          if gene_map_cache is not None: gene_map_cache.commit()
+    else:
+      n_gene_sets = import_gene_set_library_parallel(
+        plpy, input, prefix=prefix, postfix=postfix,
+        processes=processes or None, chunk_size=chunk_size*1024**2, commit=not benchmark,
+        gene_map_cache=gene_map_cache,
+      )
+  if benchmark:
+    seconds = time.perf_counter() - start
+    click.echo(f"{n_gene_sets} gene sets in {seconds:.1f}s ({n_gene_sets / seconds:.0f} rows/s) with {processes or os.cpu_count()} processes")
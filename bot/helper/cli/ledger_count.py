@@ -0,0 +1,13 @@
+import click
+from pathlib import Path
+from helper.cli import cli
+
+@cli.command()
+@click.option('-i', '--input', type=click.Path(exists=True, file_okay=True, path_type=Path), help='Ledger written by download_extract')
+@click.option('--run', type=int, default=None, help='Run to count packages of (default: the latest)')
+@click.option('--status', type=click.Choice(['ok', 'error', 'timeout', 'skipped', 'done']), default=None, help='Only count packages with this outcome')
+@click.option('--new-only', is_flag=True, help='Only count packages first attempted in the run, not retries')
+def ledger_count(input, run, status, new_only):
+  from helper.ledger import Ledger
+  with Ledger(input) as ledger:
+    click.echo(ledger.count(run=run, status=status, new_only=new_only))
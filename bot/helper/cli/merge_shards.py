@@ -0,0 +1,98 @@
+import re
+import heapq
+import click
+from pathlib import Path
+from helper.cli import cli
+
+def _shard_dirs(data_dir: Path):
+  ''' The shard-i-of-n directories in data_dir, ordered by i, checking that they're complete
+  '''
+  shards = {}
+  for shard_dir in data_dir.glob('shard-*-of-*'):
+    m = re.fullmatch(r'shard-(\d+)-of-(\d+)', shard_dir.name)
+    if m: shards[int(m.group(1)), int(m.group(2))] = shard_dir
+  counts = {shard_count for _, shard_count in shards}
+  if len(counts) != 1:
+    raise click.ClickException(f"Expected the shards of a single partitioning in {data_dir}, found {sorted(shards)}")
+  shard_count, = counts
+  missing = set(range(shard_count)) - {shard_index for shard_index, _ in shards}
+  if missing:
+    raise click.ClickException(f"Missing shards {sorted(missing)} of {shard_count}")
+  return [shards[shard_index, shard_count] for shard_index in range(shard_count)]
+
+def _gmt_index(path: Path, shard: int):
+  ''' (term, shard, offset) of each line of a gmt, sorted by term. Only the terms are kept in
+  memory, lines are copied from the file by offset when merging.
+  '''
+  index = []
+  if not path.exists(): return index
+  with path.open('rb') as fr:
+    offset = 0
+    for line in fr:
+      if line.strip():
+        index.append((line.split(b'\t', 1)[0], shard, offset))
+      offset += len(line)
+  index.sort()
+  return index
+
+@cli.command()
+@click.option('-d', '--data-dir', envvar='PTH', default='data', type=click.Path(exists=True, file_okay=False, path_type=Path), help='Directory with the shard-i-of-n outputs of download_extract')
+@click.option('--output', default='output.gmt', help='Gene sets file name, in the shards & the merged result')
+@click.option('--progress-output', default='done.new.txt', help='Processed packages file name, in the shards & the merged result')
+@click.option('--stats-output', default='stats.jsonl', help='Package statistics file name, in the shards & the merged result')
+@click.option('--ledger', default='ledger.sqlite', help='Ledger file name, in the shards & the merged result')
+@click.option('--progress', default='done.txt', help='Legacy progress file to seed a new merged ledger with')
+def merge_shards(data_dir, output, progress_output, stats_output, ledger, progress):
+  ''' Combine the outputs of download_extract --shard i/N into data_dir: gene sets are ordered
+  by term (keeping the first of any duplicate term), processed packages are sorted and the
+  shards' ledgers are merged into a single run of the main ledger.
+  '''
+  from helper.ledger import Ledger
+  shard_dirs = _shard_dirs(data_dir)
+
+  # gene sets
+  readers = [(shard_dir / output).open('rb') if (shard_dir / output).exists() else None for shard_dir in shard_dirs]
+  try:
+    with (data_dir / output).open('wb') as fw:
+      previous_term = None
+      for term, shard, offset in heapq.merge(*(_gmt_index(shard_dir / output, shard) for shard, shard_dir in enumerate(shard_dirs))):
+        if term == previous_term: continue
+        previous_term = term
+        readers[shard].seek(offset)
+        line = readers[shard].readline()
+        fw.write(line if line.endswith(b'\n') else line + b'\n')
+  finally:
+    for reader in readers:
+      if reader is not None: reader.close()
+
+  # processed packages
+  done = set()
+  for shard_dir in shard_dirs:
+    if (shard_dir / progress_output).exists():
+      with (shard_dir / progress_output).open('r') as fr:
+        done.update(filter(None, map(str.strip, fr)))
+  with (data_dir / progress_output).open('w') as fw:
+    for oa_package in sorted(done):
+      print(oa_package, file=fw)
+
+  # package statistics
+  with (data_dir / stats_output).open('wb') as fw:
+    for shard_dir in shard_dirs:
+      if (shard_dir / stats_output).exists():
+        with (shard_dir / stats_output).open('rb') as fr:
+          for line in fr:
+            fw.write(line)
+
+  # ledger
+  with Ledger(data_dir / ledger) as main_ledger:
+    if not len(main_ledger):
+      main_ledger.import_done(data_dir / progress)
+    main_ledger.start_run()
+    shard_costs = [main_ledger.merge_shard(shard_dir / ledger) for shard_dir in shard_dirs if (shard_dir / ledger).exists()]
+    costs = {}
+    for key in {key for shard_cost in shard_costs for key in shard_cost}:
+      values = [shard_cost[key] for shard_cost in shard_costs if key in shard_cost]
+      costs[key] = sum(values) / len(values)
+    main_ledger.save_costs(costs)
+    main_ledger.finish_run()
+    click.echo(f"merged {len(shard_dirs)} shards: {len(done)} packages, {main_ledger.count()} in the ledger's run")
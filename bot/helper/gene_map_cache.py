@@ -0,0 +1,97 @@
+''' A local cache of app_public_v2.gene_map, symbol -> gene_id.
+
+Ingest resolves the same symbols every week, each of them a probe of gene.symbol &
+gene.synonyms in postgres. The cache remembers the gene_id of every symbol resolved (or
+inserted) so far, it's only valid for the version of the gene table it was saved with
+(see: ingest.gene_table_version), otherwise it's cleared.
+
+Writes are staged in a sqlite transaction and only kept when the ingest which made them
+is committed (see: GeneMapCache.commit), so the cache never refers to rolled back genes.
+'''
+import sqlite3
+from pathlib import Path
+
+_schema = '''
+create table if not exists version (
+  id integer primary key check (id = 0),
+  version text not null
+);
+create table if not exists gene (
+  symbol text primary key,
+  gene_id text not null
+);
+'''
+
+class GeneMapCache:
+  ''' symbol -> gene_id, stored in sqlite, valid for a given version of the gene table
+  '''
+  def __init__(self, path: Path | str):
+    self.path = Path(path)
+    self.conn = sqlite3.connect(self.path)
+    self.conn.executescript(_schema)
+    self.conn.commit()
+    self.hits = 0
+    self.misses = 0
+
+  def validate(self, version: str):
+    ''' Clear the cache unless it was saved with this version of the gene table
+    '''
+    row = self.conn.execute('select version from version where id = 0').fetchone()
+    if row is None or row[0] != version:
+      self.conn.execute('delete from gene')
+      self.conn.execute('delete from version')
+      self.conn.commit()
+
+  def get_many(self, symbols) -> dict:
+    ''' The cached gene_ids of the given symbols, counting hits & misses
+    '''
+    symbols = list(symbols)
+    self.conn.execute('create temp table if not exists candidate_symbol (symbol text primary key)')
+    self.conn.execute('delete from candidate_symbol')
+    self.conn.executemany('insert into candidate_symbol (symbol) values (?) on conflict do nothing', ((symbol,) for symbol in symbols))
+    gene_map = dict(self.conn.execute('''
+      select gene.symbol, gene.gene_id
+      from candidate_symbol
+      inner join gene on gene.symbol = candidate_symbol.symbol
+    '''))
+    self.conn.execute('delete from candidate_symbol')
+    self.hits += len(gene_map)
+    self.misses += len(symbols) - len(gene_map)
+    return gene_map
+
+  def put_many(self, gene_map: dict):
+    ''' Stage symbol -> gene_id mappings, see: commit
+    '''
+    self.conn.executemany(
+      'insert into gene (symbol, gene_id) values (?, ?) on conflict (symbol) do update set gene_id = excluded.gene_id',
+      gene_map.items()
+    )
+
+  def stage(self, version: str):
+    ''' Stage the version of the gene table the staged mappings are valid for, see: commit
+    '''
+    self.conn.execute(
+      'insert into version (id, version) values (0, ?) on conflict (id) do update set version = excluded.version',
+      (version,)
+    )
+
+  def commit(self):
+    ''' Keep what was staged, once the ingest it came from was committed
+    '''
+    self.conn.commit()
+
+  def rollback(self):
+    self.conn.rollback()
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.
+
+  def close(self):
+    self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
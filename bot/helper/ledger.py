@@ -0,0 +1,357 @@
+''' A local sqlite ledger of the oa_packages we've processed.
+
+Each package has a single row with the outcome of its latest attempt:
+  ok       extracted successfully
+  error    extraction failed (error holds the exception class)
+  timeout  extraction ran out of time, retried with a larger budget (see: Ledger.retries)
+  skipped  not downloaded, its article's listing shows it can't yield gene sets
+  done     imported from a legacy done.txt, outcome unknown
+
+Every invocation of download_extract registers a run, packages are attributed to the
+run of their latest attempt. What remains to be done is found by anti-joining the synced
+oa_file_list (see: Ledger.pending_oa_files) with the packages. The outcome of each
+supplementary file is recorded in member, and the cost model used to schedule packages is
+kept here too, so that it carries over from run to run. So are the listings of articles
+(the extensions of their supplementary files & the number of gene sets in their tables)
+which packages are pre-filtered by.
+
+The terms of the gene sets a timed out package yielded before it ran out of time are kept in
+emitted_term, they're already in the output so its retries skip them (see: Ledger.emitted_terms).
+'''
+import sqlite3
+import datetime
+from pathlib import Path
+
+_schema = '''
+create table if not exists run (
+  id integer primary key autoincrement,
+  started text not null,
+  finished text
+);
+create table if not exists package (
+  file text primary key,
+  status text not null,
+  error text,
+  attempts integer not null default 1,
+  timeout real,
+  seconds real,
+  download_seconds real,
+  bytes integer,
+  gene_sets integer,
+  run integer references run (id),
+  updated text not null
+);
+create index if not exists package_status_idx on package (status);
+create index if not exists package_run_idx on package (run);
+create table if not exists member (
+  file text not null,
+  member text not null,
+  status text not null,
+  seconds real,
+  run integer references run (id),
+  primary key (file, member)
+);
+create table if not exists listing (
+  accession text primary key,
+  extensions text not null,
+  gene_tables integer not null,
+  fetched text not null
+);
+create table if not exists cost (
+  key text primary key,
+  value real not null
+);
+create table if not exists emitted_term (
+  file text not null,
+  term text not null,
+  primary key (file, term)
+);
+'''
+
+def _now():
+  return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class Ledger:
+  ''' Per-package status, timings & sizes, stored in sqlite
+  '''
+  def __init__(self, path: Path | str):
+    self.path = Path(path)
+    self.conn = sqlite3.connect(self.path)
+    self.conn.execute('pragma synchronous = normal')
+    self.conn.executescript(_schema)
+    self.conn.commit()
+    self.run = None
+
+  def __len__(self):
+    count, = self.conn.execute('select count(*) from package').fetchone()
+    return count
+
+  def import_done(self, done_file: Path | str):
+    ''' Import the packages listed in a legacy done.txt, leaving the ones we know more about alone
+    '''
+    done_file = Path(done_file)
+    if not done_file.exists(): return 0
+    with done_file.open('r') as fr:
+      cur = self.conn.executemany(
+        "insert into package (file, status, updated) values (?, 'done', ?) on conflict (file) do nothing",
+        ((file, _now()) for file in filter(None, map(str.strip, fr)))
+      )
+    self.conn.commit()
+    return cur.rowcount
+
+  def import_ledger(self, path: Path | str, keep=None):
+    ''' Seed this ledger with the packages, listings & costs of another one (i.e. a shard's ledger
+    with the main ledger), optionally only the packages for which keep(file) is true. Imported
+    packages aren't attributed to any run.
+    '''
+    self.conn.create_function('keep', 1, keep or (lambda file: True), deterministic=True)
+    self.conn.execute('attach database ? as other', (str(path),))
+    try:
+      self.conn.execute('''
+        insert into package (file, status, error, attempts, timeout, seconds, download_seconds, bytes, gene_sets, run, updated)
+        select file, status, error, attempts, timeout, seconds, download_seconds, bytes, gene_sets, null, updated
+        from other.package
+        where keep(file)
+        on conflict (file) do nothing
+      ''')
+      self.conn.execute('insert into listing select * from other.listing where true on conflict (accession) do nothing')
+      self.conn.execute('insert into cost select * from other.cost where true on conflict (key) do nothing')
+      if self._has_table('other', 'emitted_term'):
+        self.conn.execute('insert into emitted_term select * from other.emitted_term where keep(file) on conflict do nothing')
+      self.conn.commit()
+    finally:
+      self.conn.execute('detach database other')
+
+  def merge_shard(self, path: Path | str):
+    ''' Merge what was done in a shard's ledger (see: import_ledger) into the current run of this one
+    '''
+    self.conn.execute('attach database ? as shard', (str(path),))
+    try:
+      self.conn.execute('''
+        insert into package (file, status, error, attempts, timeout, seconds, download_seconds, bytes, gene_sets, run, updated)
+        select file, status, error, attempts, timeout, seconds, download_seconds, bytes, gene_sets, ?, updated
+        from shard.package
+        where run is not null
+        on conflict (file) do update set
+          status = excluded.status,
+          error = excluded.error,
+          attempts = excluded.attempts,
+          timeout = excluded.timeout,
+          seconds = excluded.seconds,
+          download_seconds = excluded.download_seconds,
+          bytes = excluded.bytes,
+          gene_sets = excluded.gene_sets,
+          run = excluded.run,
+          updated = excluded.updated
+      ''', (self.run,))
+      self.conn.execute('''
+        insert into member (file, member, status, seconds, run)
+        select file, member, status, seconds, ?
+        from shard.member
+        where true
+        on conflict (file, member) do update set
+          status = excluded.status,
+          seconds = excluded.seconds,
+          run = excluded.run
+      ''', (self.run,))
+      self.conn.execute('''
+        insert into listing select * from shard.listing where true
+        on conflict (accession) do update set
+          extensions = excluded.extensions,
+          gene_tables = excluded.gene_tables,
+          fetched = excluded.fetched
+      ''')
+      if self._has_table('shard', 'emitted_term'):
+        self.conn.execute('insert into emitted_term select * from shard.emitted_term where true on conflict do nothing')
+      self.conn.commit()
+      return dict(self.conn.execute('select key, value from shard.cost'))
+    finally:
+      self.conn.execute('detach database shard')
+
+  def _has_table(self, schema, name):
+    ''' Whether an attached ledger has the table, older ledgers don't have all of them
+    '''
+    return self.conn.execute(f"select 1 from {schema}.sqlite_master where type = 'table' and name = ?", (name,)).fetchone() is not None
+
+  def start_run(self):
+    self.run = self.conn.execute('insert into run (started) values (?)', (_now(),)).lastrowid
+    self.conn.commit()
+    return self.run
+
+  def finish_run(self):
+    self.conn.execute('update run set finished = ? where id = ?', (_now(), self.run))
+    self.conn.commit()
+
+  def pending(self, files):
+    ''' The files which aren't in the ledger yet, in the order they were given
+    '''
+    self.conn.execute('create temp table if not exists candidate (position integer primary key, file text not null)')
+    self.conn.execute('delete from candidate')
+    self.conn.executemany('insert into candidate (file) values (?)', ((file,) for file in files))
+    pending = [
+      file
+      for file, in self.conn.execute('''
+        select candidate.file
+        from candidate
+        left join package on package.file = candidate.file
+        where package.file is null
+        order by candidate.position
+      ''')
+    ]
+    self.conn.execute('delete from candidate')
+    self.conn.commit()
+    return pending
+
+  def pending_oa_files(self, file_list: Path | str, keep=None):
+    ''' The (file, accession) of the packages in a synced oa_file_list (see: helper.oa_file_list)
+    which aren't in the ledger yet, newest first, optionally only those for which keep(file) is true
+    '''
+    self.conn.create_function('keep', 1, keep or (lambda file: True), deterministic=True)
+    self.conn.execute('attach database ? as oa', (str(file_list),))
+    try:
+      return self.conn.execute('''
+        select oa_file.file, oa_file.accession
+        from oa.oa_file
+        left join package on package.file = oa_file.file
+        where package.file is null and keep(oa_file.file)
+        order by oa_file.updated desc
+      ''').fetchall()
+    finally:
+      self.conn.execute('detach database oa')
+
+  def retries(self, max_attempts: int, timeout_factor: float):
+    ''' The timed out packages which deserve another attempt, with their new time budget
+    '''
+    return [
+      (file, timeout * timeout_factor)
+      for file, timeout in self.conn.execute(
+        "select file, timeout from package where status = 'timeout' and attempts < ? order by attempts, file",
+        (max_attempts,)
+      )
+    ]
+
+  def record(self, file, status, error=None, timeout=None, seconds=None, download_seconds=None, bytes=None, gene_sets=None):
+    ''' Record the outcome of an attempt at the package
+    '''
+    self.conn.execute('''
+      insert into package (file, status, error, timeout, seconds, download_seconds, bytes, gene_sets, run, updated)
+      values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+      on conflict (file) do update set
+        status = excluded.status,
+        error = excluded.error,
+        attempts = package.attempts + 1,
+        timeout = excluded.timeout,
+        seconds = excluded.seconds,
+        download_seconds = excluded.download_seconds,
+        bytes = excluded.bytes,
+        gene_sets = excluded.gene_sets,
+        run = excluded.run,
+        updated = excluded.updated
+    ''', (file, status, error, timeout, seconds, download_seconds, bytes, gene_sets, self.run, _now()))
+    self.conn.commit()
+
+  def skip(self, files):
+    ''' Record packages which were skipped without being downloaded
+    '''
+    self.conn.executemany('''
+      insert into package (file, status, run, updated)
+      values (?, 'skipped', ?, ?)
+      on conflict (file) do update set
+        status = excluded.status,
+        attempts = package.attempts + 1,
+        run = excluded.run,
+        updated = excluded.updated
+    ''', ((file, self.run, _now()) for file in files))
+    self.conn.commit()
+
+  def listings(self, accessions):
+    ''' The cached listings of the given articles, accession -> (extensions, gene_tables)
+    '''
+    self.conn.execute('create temp table if not exists candidate_accession (accession text primary key)')
+    self.conn.execute('delete from candidate_accession')
+    self.conn.executemany('insert into candidate_accession (accession) values (?) on conflict do nothing', ((accession,) for accession in accessions))
+    listings = {
+      accession: (set(filter(None, extensions.split(' '))), gene_tables)
+      for accession, extensions, gene_tables in self.conn.execute('''
+        select listing.accession, listing.extensions, listing.gene_tables
+        from candidate_accession
+        inner join listing on listing.accession = candidate_accession.accession
+      ''')
+    }
+    self.conn.execute('delete from candidate_accession')
+    self.conn.commit()
+    return listings
+
+  def save_listings(self, listings: dict):
+    self.conn.executemany('''
+      insert into listing (accession, extensions, gene_tables, fetched)
+      values (?, ?, ?, ?)
+      on conflict (accession) do update set
+        extensions = excluded.extensions,
+        gene_tables = excluded.gene_tables,
+        fetched = excluded.fetched
+    ''', ((accession, ' '.join(sorted(extensions)), gene_tables, _now()) for accession, (extensions, gene_tables) in listings.items()))
+    self.conn.commit()
+
+  def record_members(self, file, members):
+    ''' Record the outcome (ok/error/timeout) & seconds of each supplementary file of the package
+    '''
+    self.conn.executemany('''
+      insert into member (file, member, status, seconds, run)
+      values (?, ?, ?, ?, ?)
+      on conflict (file, member) do update set
+        status = excluded.status,
+        seconds = excluded.seconds,
+        run = excluded.run
+    ''', ((file, member['member'], member['status'], member['seconds'], self.run) for member in members))
+    self.conn.commit()
+
+  def emitted_terms(self, file):
+    ''' The terms of the gene sets earlier attempts at the package already wrote to the output
+    '''
+    return {term for term, in self.conn.execute('select term from emitted_term where file = ?', (file,))}
+
+  def record_terms(self, file, terms):
+    ''' Record the terms of the gene sets an attempt at the package wrote to the output
+    '''
+    self.conn.executemany(
+      'insert into emitted_term (file, term) values (?, ?) on conflict do nothing',
+      ((file, term) for term in terms)
+    )
+    self.conn.commit()
+
+  def costs(self):
+    ''' The cost estimates saved by the last run (see: download_extract.CostModel)
+    '''
+    return dict(self.conn.execute('select key, value from cost'))
+
+  def save_costs(self, costs: dict):
+    self.conn.executemany(
+      'insert into cost (key, value) values (?, ?) on conflict (key) do update set value = excluded.value',
+      costs.items()
+    )
+    self.conn.commit()
+
+  def count(self, run=None, status=None, new_only=False):
+    ''' The number of packages attempted in a run (default: the latest), optionally by status
+    and/or only those first attempted in it (i.e. not retries)
+    '''
+    if run is None:
+      run, = self.conn.execute('select max(id) from run').fetchone()
+    query, args = 'select count(*) from package where run = ?', [run]
+    if new_only:
+      query += ' and attempts = 1'
+    if status is not None:
+      query += ' and status = ?'
+      args.append(status)
+    count, = self.conn.execute(query, args).fetchone()
+    return count
+
+  def close(self):
+    self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,181 @@
+''' A compact on-disk synonym -> symbol lookup.
+
+lookup.json is a large dict which each process would otherwise json.load on its own,
+instead we build a sorted key table from it once (lookup.bin) and memory map it,
+so all processes share the same page cache and opening it is practically free.
+
+The keys are NUL padded to a fixed width so the table can be searched by numpy
+directly (np.searchsorted), a whole batch of values at a time, see: GeneLookup.get_many.
+
+Layout (all integers are little endian uint64):
+  magic, n_keys, n_symbols, key_width
+  key_symbols[n_keys], symbol_offsets[n_symbols+1]
+  keys (utf-8, sorted bytewise, n_keys*key_width), symbols (utf-8)
+'''
+import os
+import re
+import mmap
+import json
+import struct
+import hashlib
+import functools
+import numpy as np
+from pathlib import Path
+
+_header = struct.Struct('<8sQQQ')
+_magic = b'RGLOOKU2'
+
+class GeneLookup:
+  ''' A read-only memory mapped mapping from gene synonym to gene symbol
+  '''
+  def __init__(self, path: Path | str):
+    with open(path, 'rb') as fr:
+      self._mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self._mm) < _header.size:
+      raise ValueError(f"{path} is not a gene lookup")
+    magic, self._n_keys, n_symbols, self._key_width = _header.unpack_from(self._mm, 0)
+    if magic != _magic:
+      raise ValueError(f"{path} is not a gene lookup")
+    offset = _header.size
+    self._key_symbols = np.frombuffer(self._mm, dtype='<u8', count=self._n_keys, offset=offset)
+    offset += 8*self._n_keys
+    self._symbol_offsets = np.frombuffer(self._mm, dtype='<u8', count=n_symbols+1, offset=offset)
+    offset += 8*(n_symbols+1)
+    self._keys = np.frombuffer(self._mm, dtype=f"S{self._key_width}", count=self._n_keys, offset=offset)
+    offset += self._n_keys*self._key_width
+    self._symbols_start = offset
+
+  @staticmethod
+  def build(lookup: dict, path: Path | str):
+    ''' Write the lookup dict to path in the binary format, atomically
+    '''
+    # NUL padding can't represent empty keys or keys with NULs, no gene has those anyway
+    keys = sorted((key.encode(), value) for key, value in lookup.items() if key and '\0' not in key)
+    key_width = max((len(key) for key, _ in keys), default=1)
+    symbols = sorted(set(lookup.values()))
+    symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+    symbols = [symbol.encode() for symbol in symbols]
+    def offsets(items):
+      offset = 0
+      yield offset
+      for item in items:
+        offset += len(item)
+        yield offset
+    tmp = Path(f"{path}.{os.getpid()}.tmp")
+    with tmp.open('wb') as fw:
+      fw.write(_header.pack(_magic, len(keys), len(symbols), key_width))
+      fw.write(struct.pack(f"<{len(keys)}Q", *(symbol_index[value] for _, value in keys)))
+      fw.write(struct.pack(f"<{len(symbols)+1}Q", *offsets(symbols)))
+      fw.write(np.array([key for key, _ in keys], dtype=f"S{key_width}").tobytes())
+      for symbol in symbols: fw.write(symbol)
+    os.replace(tmp, path)
+
+  @staticmethod
+  def from_json(path: Path | str):
+    ''' Open the binary lookup next to a lookup.json, (re-)building it if necessary
+    '''
+    path = Path(path)
+    bin_path = path.with_suffix('.bin')
+    if bin_path.exists() and bin_path.stat().st_mtime >= path.stat().st_mtime:
+      try:
+        return GeneLookup(bin_path)
+      except ValueError:
+        # i.e. written in an older layout
+        pass
+    with path.open('r') as fr:
+      GeneLookup.build(json.load(fr), bin_path)
+    return GeneLookup(bin_path)
+
+  @functools.cached_property
+  def digest(self):
+    ''' A digest of the contents of the lookup, i.e. to tell results computed with it apart
+    '''
+    return hashlib.sha256(self._mm).hexdigest()
+
+  @functools.cached_property
+  def _symbol_table(self):
+    ''' All the symbols, decoded once (there are far fewer of them than keys)
+    '''
+    symbols = np.empty(len(self._symbol_offsets) - 1, dtype=object)
+    offsets = self._symbol_offsets.tolist()
+    for i in range(len(symbols)):
+      symbols[i] = self._mm[self._symbols_start + offsets[i]:self._symbols_start + offsets[i+1]].decode()
+    return symbols
+
+  def _find(self, keys):
+    ''' Whether each key is in the table, and where
+    '''
+    targets = [key.encode() for key in keys]
+    found = np.zeros(len(targets), dtype=bool)
+    index = np.zeros(len(targets), dtype=np.intp)
+    # longer keys would be truncated to the width by numpy, & can't be in the table anyway
+    candidates = [i for i, target in enumerate(targets) if 0 < len(target) <= self._key_width and b'\0' not in target]
+    if candidates and self._n_keys:
+      candidate_targets = np.array([targets[i] for i in candidates], dtype=self._keys.dtype)
+      candidate_index = np.minimum(np.searchsorted(self._keys, candidate_targets), self._n_keys - 1)
+      found[candidates] = self._keys[candidate_index] == candidate_targets
+      index[candidates] = candidate_index
+    return found, index
+
+  def get_many(self, keys):
+    ''' The symbols of many keys at once (an object array, None where a key isn't found)
+    '''
+    found, index = self._find(keys)
+    symbols = np.full(len(found), None, dtype=object)
+    symbols[found] = self._symbol_table[self._key_symbols[index[found]]]
+    return symbols
+
+  def contains_many(self, keys):
+    ''' A boolean mask of the keys which are found
+    '''
+    found, _ = self._find(keys)
+    return found
+
+  @functools.lru_cache(maxsize=2**16)
+  def get(self, key: str, default=None):
+    target = key.encode()
+    if not 0 < len(target) <= self._key_width or b'\0' in target: return default
+    i = int(np.searchsorted(self._keys, target))
+    if i < self._n_keys and self._keys[i] == target:
+      return self._symbol_table[self._key_symbols[i]]
+    return default
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def __getitem__(self, key):
+    value = self.get(key)
+    if value is None: raise KeyError(key)
+    return value
+
+  def __len__(self):
+    return self._n_keys
+
+@functools.cache
+def open_lookup(path: Path | str = 'lookup.json'):
+  ''' The (per-process) GeneLookup for a given lookup.json
+  '''
+  return GeneLookup.from_json(path)
+
+_whitespace = re.compile(r'\s')
+_number = re.compile(r'\d+(\.\d+)?')
+
+def gene_lookup(value, path: Path | str = 'lookup.json'):
+  ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
+  '''
+  if type(value) != str: return None
+  if _whitespace.search(value): return None
+  if _number.match(value): return None
+  return open_lookup(path).get(value)
+
+def gene_lookup_many(values, path: Path | str = 'lookup.json'):
+  ''' gene_lookup of many values at once, an object array of the symbols (or None)
+  '''
+  valid = [
+    i for i, value in enumerate(values)
+    if type(value) == str and not _whitespace.search(value) and not _number.match(value)
+  ]
+  symbols = np.full(len(values), None, dtype=object)
+  if valid:
+    symbols[valid] = open_lookup(path).get_many([values[i] for i in valid])
+  return symbols
@@ -0,0 +1,128 @@
+''' A local, incrementally synced copy of PMC's oa_file_list.csv.
+
+The csv lists millions of packages, rather than downloading & sorting all of it for every
+run we keep it in a sqlite table indexed by the package's last updated timestamp. A sync
+is a conditional GET (ETag/Last-Modified), when the list changed it's streamed into the
+table and only the rows which are new or whose timestamp changed are written.
+'''
+import io
+import csv
+import sqlite3
+import datetime
+from pathlib import Path
+
+oa_file_list_url = 'https://ftp.ncbi.nlm.nih.gov/pub/pmc/deprecated/oa_file_list.csv'
+
+_schema = '''
+create table if not exists source (
+  url text primary key,
+  etag text,
+  last_modified text,
+  synced text not null
+);
+create table if not exists sync (
+  id integer primary key autoincrement,
+  url text not null,
+  started text not null,
+  new integer,
+  changed integer
+);
+create table if not exists oa_file (
+  file text primary key,
+  accession text not null,
+  updated text not null,
+  sync integer references sync (id)
+);
+create index if not exists oa_file_updated_idx on oa_file (updated);
+create index if not exists oa_file_sync_idx on oa_file (sync);
+'''
+
+def _now():
+  return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class FileList:
+  ''' The oa_file_list (file, accession, last updated), stored in sqlite
+  '''
+  def __init__(self, path: Path | str):
+    self.path = Path(path)
+    self.conn = sqlite3.connect(self.path, timeout=60*60, isolation_level=None)
+    self.conn.execute('pragma journal_mode = wal')
+    self.conn.execute('pragma synchronous = normal')
+    self.conn.executescript(_schema)
+
+  def sync(self, url: str = oa_file_list_url, session=None):
+    ''' Bring the table up to date with the list at url, returns the (new, changed) number of rows.
+    Concurrent syncs (i.e. by shards) wait for each other, the later ones then find it unchanged.
+    '''
+    import requests
+    session = session or requests
+    self.conn.execute('begin immediate')
+    try:
+      headers = {}
+      row = self.conn.execute('select etag, last_modified from source where url = ?', (url,)).fetchone()
+      if row is not None:
+        etag, last_modified = row
+        if etag: headers['If-None-Match'] = etag
+        if last_modified: headers['If-Modified-Since'] = last_modified
+      with session.get(url, headers=headers, stream=True, timeout=60) as req:
+        if req.status_code == 304:
+          self.conn.execute('update source set synced = ? where url = ?', (_now(), url))
+          self.conn.execute('commit')
+          return 0, 0
+        req.raise_for_status()
+        req.raw.decode_content = True
+        # or the TextIOWrapper finds it closed as soon as it's been read to the end
+        req.raw.auto_close = False
+        reader = csv.reader(io.TextIOWrapper(req.raw, encoding='utf-8', newline=''))
+        header = next(reader)
+        file_col, accession_col = header.index('File'), header.index('Accession ID')
+        # the last updated timestamp, which we order the list by
+        updated_col = len(header) - 3
+        sync_id = self.conn.execute('insert into sync (url, started) values (?, ?)', (url, _now())).lastrowid
+        before, = self.conn.execute('select count(*) from oa_file').fetchone()
+        changes = self.conn.total_changes
+        self.conn.executemany('''
+          insert into oa_file (file, accession, updated, sync)
+          values (?, ?, ?, ?)
+          on conflict (file) do update set
+            accession = excluded.accession,
+            updated = excluded.updated,
+            sync = excluded.sync
+          where oa_file.updated is not excluded.updated
+        ''', ((row[file_col], row[accession_col], row[updated_col], sync_id) for row in reader if row))
+        changes = self.conn.total_changes - changes
+        after, = self.conn.execute('select count(*) from oa_file').fetchone()
+        new, changed = after - before, changes - (after - before)
+        self.conn.execute('update sync set new = ?, changed = ? where id = ?', (new, changed, sync_id))
+        self.conn.execute('''
+          insert into source (url, etag, last_modified, synced)
+          values (?, ?, ?, ?)
+          on conflict (url) do update set
+            etag = excluded.etag,
+            last_modified = excluded.last_modified,
+            synced = excluded.synced
+        ''', (url, req.headers.get('ETag'), req.headers.get('Last-Modified'), _now()))
+      self.conn.execute('commit')
+    except:
+      self.conn.execute('rollback')
+      raise
+    return new, changed
+
+  def count(self, keep=None):
+    ''' The number of packages in the list, optionally only those for which keep(file) is true
+    '''
+    if keep is None:
+      count, = self.conn.execute('select count(*) from oa_file').fetchone()
+    else:
+      self.conn.create_function('keep', 1, keep, deterministic=True)
+      count, = self.conn.execute('select count(*) from oa_file where keep(file)').fetchone()
+    return count
+
+  def close(self):
+    self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,61 @@
+''' Timing instrumentation for download_extract.
+
+Durations are observed under a family (i.e. stage, extension, outcome) & key and aggregated
+into a count, total, max & a histogram with log-spaced buckets (in seconds). The report is a
+json file, rewritten periodically during the run and once more at the end of it.
+'''
+import os
+import json
+import time
+import bisect
+import datetime
+from pathlib import Path
+
+def _now():
+  return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class TimingReport:
+  ''' Aggregated timings, written to a json report at `path` at most every `interval` seconds
+  '''
+  bounds = (0.01, 0.1, 1, 10, 60, 300, 1800)
+  labels = ('<0.01s', '<0.1s', '<1s', '<10s', '<1m', '<5m', '<30m', '>=30m')
+
+  def __init__(self, path: Path | str, interval: float = 60):
+    self.path = Path(path)
+    self.interval = interval
+    self.started = _now()
+    self._start = time.monotonic()
+    self._written = self._start
+    self.families = {}
+
+  def observe(self, family: str, key: str, seconds: float):
+    timing = self.families.setdefault(family, {}).setdefault(key, dict(
+      count=0, total=0., max=0., histogram=dict.fromkeys(self.labels, 0),
+    ))
+    timing['count'] += 1
+    timing['total'] += seconds
+    timing['max'] = max(timing['max'], seconds)
+    timing['histogram'][self.labels[bisect.bisect_right(self.bounds, seconds)]] += 1
+
+  def write(self, finished=False, **extra):
+    ''' Write the report (atomically), extra is included as is
+    '''
+    self._written = time.monotonic()
+    report = dict(
+      started=self.started,
+      updated=_now(),
+      finished=finished,
+      elapsed=self._written - self._start,
+      **extra,
+      timings=self.families,
+    )
+    tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+    with tmp.open('w') as fw:
+      json.dump(report, fw, indent=2)
+    os.replace(tmp, self.path)
+
+  def maybe_write(self, **extra):
+    ''' Write the report if it's been at least interval seconds since it was last written
+    '''
+    if time.monotonic() - self._written >= self.interval:
+      self.write(**extra)
@@ -2,6 +2,7 @@
 '''
 import re
 import io
+import sys
 import pathlib
 import contextlib
 import typing
@@ -30,19 +31,15 @@ def maybe_tqdm(iterable, **kwargs):
   except ImportError:
     return iterable
 
-lookup = None
+# the gene lookup is shared with the bot (see: bot/helper/lookup.py)
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent / 'bot'))
+from helper.lookup import gene_lookup as _gene_lookup
+lookup_path = data_dir/'lookup.json'
+
 def gene_lookup(value):
   ''' Don't allow pure numbers or spaces--numbers can typically match entrez ids
   '''
-  if type(value) != str: return None
-  if re.search(r'\s', value): return None
-  if re.match(r'\d+(\.\d+)?', value): return None
-  global lookup
-  if lookup is None:
-    import json
-    with open(data_dir/'lookup.json', 'r') as fr:
-      lookup = json.load(fr).get
-  return lookup(value)
+  return _gene_lookup(value, lookup_path)
 
 @contextlib.contextmanager
 def ensure_io(arg: io.TextIOBase | str | pathlib.Path):